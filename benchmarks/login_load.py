@@ -0,0 +1,83 @@
+# Device API latency while logins hash passwords.
+#
+#   python benchmarks/login_load.py --base-url http://localhost:8000 --username bench --password secret --system-id 1
+#
+# Measures latency of /api/valvestatus/{system_id} alone, then again while
+# a burst of concurrent /login requests runs against the same server, and
+# reports login throughput. The probe reads the database, so it stalls when
+# logins hold pooled connections while they hash. The user and the system
+# must exist. Needs httpx (requirements-dev.txt).
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+def summary(timings: list):
+    timings = sorted(timings)
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1], timings[-1]
+
+async def probe(client: httpx.AsyncClient, path: str, stop: asyncio.Event, interval: float):
+    timings = []
+    while not stop.is_set():
+        start = time.perf_counter()
+        response = await client.get(path)
+        response.raise_for_status()
+        timings.append((time.perf_counter() - start) * 1000)
+        await asyncio.sleep(interval)
+    return timings
+
+async def login_burst(client: httpx.AsyncClient, username: str, password: str, total: int, concurrency: int):
+    statuses = {}
+    queue = asyncio.Queue()
+    for _ in range(total):
+        queue.put_nowait(None)
+
+    async def worker():
+        while not queue.empty():
+            queue.get_nowait()
+            response = await client.post("/login", data={"username": username, "password": password})
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - start, statuses
+
+async def run(args):
+    limits = httpx.Limits(max_connections=args.concurrency + 10)
+    path = f"/api/valvestatus/{args.system_id}"
+    async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=60) as client:
+        stop = asyncio.Event()
+        idle = asyncio.create_task(probe(client, path, stop, args.interval))
+        await asyncio.sleep(args.idle_seconds)
+        stop.set()
+        idle_timings = await idle
+
+        stop = asyncio.Event()
+        loaded = asyncio.create_task(probe(client, path, stop, args.interval))
+        elapsed, statuses = await login_burst(client, args.username, args.password,
+                                              args.logins, args.concurrency)
+        stop.set()
+        loaded_timings = await loaded
+
+    print(f"{'phase':<14} {'requests':>9} {'median ms':>10} {'p95 ms':>10} {'max ms':>10}")
+    for name, timings in (("idle", idle_timings), ("during logins", loaded_timings)):
+        median, p95, worst = summary(timings)
+        print(f"{name:<14} {len(timings):>9} {median:>10.2f} {p95:>10.2f} {worst:>10.2f}")
+    print(f"logins: {args.logins} in {elapsed:.2f}s = {args.logins / elapsed:.1f}/s, statuses {statuses}")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--username", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--system-id", type=int, required=True, help="System polled by the probe")
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--interval", type=float, default=0.01)
+    parser.add_argument("--idle-seconds", type=float, default=5)
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
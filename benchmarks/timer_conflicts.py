@@ -0,0 +1,92 @@
+# Timer conflict check against the number of timers in a system.
+#
+#   python benchmarks/timer_conflicts.py --sizes 10 100 500 1000
+#
+# Times one create/update check, i.e. building the weekly interval index
+# from the system's timers and probing the new timer, against the pairwise
+# loop the routes used before. No database is needed.
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime
+from datetime import time as dtime
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import schedule
+
+# Pairwise check as it was in crud.py, timers are compared as serialized dicts
+def parse_time(time_str):
+    return datetime.strptime(time_str, "%H:%M:%S").time()
+
+def do_timers_interfere(timer1, timer2):
+    for day in schedule.DAYS:
+        if timer1[day] and timer2[day]:
+            start_time1 = parse_time(timer1["starts"])
+            stop_time1 = parse_time(timer1["stops"])
+            start_time2 = parse_time(timer2["starts"])
+            stop_time2 = parse_time(timer2["stops"])
+            if (
+                (start_time1 < stop_time1 and start_time2 < stop_time2 and
+                 ((start_time1 <= start_time2 < stop_time1) or
+                  (start_time1 < stop_time2 <= stop_time1) or
+                  (start_time2 <= start_time1 < stop_time2) or
+                  (start_time2 < stop_time1 <= stop_time2))) or
+                (start_time1 == stop_time1 and start_time2 == stop_time2 and
+                 start_time1 == start_time2)
+            ):
+                return True
+            else:
+                return False
+
+def serialize(timer):
+    return {"starts": timer.starts.strftime("%H:%M:%S"), "stops": timer.stops.strftime("%H:%M:%S"),
+            **{day: getattr(timer, day) for day in schedule.DAYS}}
+
+# Short timers on one or two weekdays so most of them don't clash
+def random_timer(rng: random.Random):
+    starts = rng.randrange(0, 86400 - 600)
+    stops = starts + rng.randrange(60, 600)
+    days = set(rng.sample(schedule.DAYS, rng.randint(1, 2)))
+    return SimpleNamespace(starts=dtime(starts // 3600, starts // 60 % 60, starts % 60),
+                           stops=dtime(stops // 3600, stops // 60 % 60, stops % 60),
+                           **{day: day in days for day in schedule.DAYS})
+
+def pairwise(timers: list, candidate):
+    check_timers = [serialize(timer) for timer in timers]
+    new_timer = serialize(candidate)
+    return any(do_timers_interfere(timer1=timer, timer2=new_timer) for timer in check_timers)
+
+def indexed(timers: list, candidate):
+    return schedule.WeeklyIntervalIndex(timers).overlaps(candidate)
+
+def measure(check, timers: list, candidates: list):
+    timings = []
+    for candidate in candidates:
+        start = time.perf_counter()
+        check(timers, candidate)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 500, 1000])
+    parser.add_argument("--repeat", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"{'timers':>7} {'pairwise ms':>12} {'index ms':>10} {'speedup':>8}")
+    for size in args.sizes:
+        timers = [random_timer(rng) for _ in range(size)]
+        candidates = [random_timer(rng) for _ in range(args.repeat)]
+        old = measure(pairwise, timers, candidates)
+        new = measure(indexed, timers, candidates)
+        print(f"{size:>7} {old:>12.3f} {new:>10.3f} {old / new:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+from threading import Lock
+from typing import Any, Optional
+import time
+
+from config import settings
+
+# Shared backends (e.g. Redis) implement these methods and are installed
+# with set_principal_cache()
+class CacheBackend:
+    def get(self, key: str) -> Optional[Any]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: Any, ttl: int):
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+class MemoryCache(CacheBackend):
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self.entries = {}
+        self.lock = Lock()
+
+    def get(self, key: str):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            return value
+
+    def set(self, key: str, value: Any, ttl: int):
+        with self.lock:
+            if len(self.entries) >= self.max_size and key not in self.entries:
+                now = time.monotonic()
+                self.entries = {k: v for k, v in self.entries.items() if v[0] >= now}
+                if len(self.entries) >= self.max_size:
+                    self.entries.pop(next(iter(self.entries)))
+            self.entries[key] = (time.monotonic() + ttl, value)
+
+    def delete(self, key: str):
+        with self.lock:
+            self.entries.pop(key, None)
+
+principal_cache: CacheBackend = MemoryCache()
+
+def set_principal_cache(backend: CacheBackend):
+    global principal_cache
+    principal_cache = backend
+
+def get_principal(username: str):
+    return principal_cache.get(username)
+
+def set_principal(username: str, principal: Any):
+    principal_cache.set(username, principal, settings.auth_cache_ttl)
+
+def invalidate_principal(username: str):
+    principal_cache.delete(username)
+
+device_cache: CacheBackend = MemoryCache()
+
+def set_device_cache(backend: CacheBackend):
+    global device_cache
+    device_cache = backend
+
+def get_device_kind(dev_id: str):
+    return device_cache.get(dev_id)
+
+def set_device_kind(dev_id: str, kind: str):
+    device_cache.set(dev_id, kind, settings.device_cache_ttl)
+
+def invalidate_device(dev_id: str):
+    device_cache.delete(dev_id)
@@ -2,9 +2,6 @@ from pydantic_settings import BaseSettings, SettingsConfigDict
 from typing import Optional, Union
 from datetime import datetime, timedelta
 import random
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
 from fastapi import HTTPException, Request
 from fastapi.security import OAuth2
 from fastapi.security.utils import get_authorization_scheme_param
@@ -21,13 +18,60 @@ class Settings(BaseSettings):
     postgres_port: str 
     postgres_db_name: str 
     
+    # Every worker opens a sync and an async pool, so the server can hold up to
+    # web workers * 2 * (db_pool_size + db_max_overflow) connections. Keep that
+    # below Postgres max_connections (100 by default), e.g. 4 workers use 48.
+    db_pool_size: int = 4
+    db_max_overflow: int = 2
+    db_pool_timeout: int = 30
+    db_pool_recycle: int = 1800
+    db_pool_pre_ping: bool = True
+    
     secret_key :str   
     algorithm: str                        
     access_token_expire_minutes: int
+    # Principal and device caches live in each worker. A change invalidates
+    # them only in the worker that handled it, the others catch up within the TTL.
+    auth_cache_ttl: int = 60
+    # Bcrypt processes per web worker
+    hash_workers: int = 2
+    hash_queue_size: int = 100
+    schedule_cache_ttl: int = 300
+    evaluation_cache_ttl: int = 300
+    pubsub_buffer_size: int = 256
+    pubsub_queue_size: int = 100
+    # "postgres" shares live events between workers with LISTEN/NOTIFY,
+    # "local" only reaches subscribers of the same worker
+    pubsub_backend: str = "postgres"
+    pubsub_keepalive: float = 30
+    pubsub_reconnect_delay: float = 1.0
+    device_cache_ttl: int = 300
+    log_buffer_size: int = 10000
+    log_batch_size: int = 500
+    log_flush_interval: float = 1.0
+    
+    web_bind: str = "0.0.0.0:8000"
+    # 0 uses one worker per available CPU
+    web_workers: int = 0
+    web_max_requests: int = 10000
+    web_max_requests_jitter: int = 1000
+    web_timeout: int = 60
+    web_graceful_timeout: int = 30
+    web_keepalive: int = 5
     
     email : str 
     password: str
     
+    smtp_server: str = "smtp-mail.outlook.com"
+    smtp_port: int = 587
+    smtp_starttls: bool = True
+    smtp_timeout: int = 30
+    smtp_idle_timeout: int = 60
+    mail_poll_interval: int = 5
+    mail_max_attempts: int = 8
+    mail_retry_backoff: int = 30
+    mail_retry_max_delay: int = 3600
+    
     model_config = SettingsConfigDict(env_file='.env')
     
 settings = Settings()
@@ -93,26 +137,3 @@ def verify_token(token: str, credentials_exception):
     
 def generate_secret():
     return ''.join(random.choices('0123456789abcdefghijklmnopqrsty', k=16))
-
-def send_key_to_mail(email: str, key: str):
-    port = 587
-    smtp_server = "smtp-mail.outlook.com"
-    sender = settings.email
-    receiver = email
-    password = settings.password
-    
-    msg = MIMEMultipart("alternative")
-    msg["Subject"] = "Request for secret key"
-    msg["From"] = sender
-    msg["To"] = receiver
-    
-    text = f"Hello.\nYour secret key:\n {key}\nWith regards.\nAgritech Team"
-    body = MIMEText(text, 'plain')
-    msg.attach(body)
-    
-    server = smtplib.SMTP(smtp_server, port)
-    server.starttls()
-    server.login(sender, password)
-    server.sendmail(sender, receiver, msg.as_string())
-    print("Email was sent!")
-    server.quit()
@@ -1,11 +1,35 @@
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, aliased, selectinload
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, insert, update, delete, or_, tuple_, func, literal, literal_column, true, union_all
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from datetime import datetime
-from fastapi import Depends, HTTPException, status
+from typing import List, Optional, Tuple
+import base64
+import hashlib
+from fastapi import Depends, HTTPException, Request, status
 
 import models
 import schema
 import config
 import db
+import cache
+import hashing
+import pubsub
+
+# Eager loading of nested schemas, one query per relationship level
+def shift_tree():
+    return [selectinload(models.Shift.shifts_sections).selectinload(models.Section.section_sensors),
+            selectinload(models.Shift.shift_timers)]
+
+def system_tree():
+    return [selectinload(models.System.system_pumps),
+            selectinload(models.System.system_valves),
+            selectinload(models.System.system_sensors),
+            selectinload(models.System.system_shifts).options(*shift_tree())]
+
+def user_tree():
+    return [selectinload(models.User.systems).options(*system_tree()),
+            selectinload(models.User.alerts)]
 
 # Handle system
 def get_systems(db: Session, skip: int = 0, limit: int = 50):
@@ -40,9 +64,7 @@ def delete_system(system_id: int, db: Session):
         models.System.id == system_id)
     if not existing_system.first():
         return False
-    existing_system.delete(synchronize_session=False)
-    db.commit()
-    return True
+    return run_deletes(db=db, steps=system_delete_steps(system_id=system_id))
 
 # Handle pumps
 def get_pumps(db: Session, skip: int = 0, limit: int = 50):
@@ -78,6 +100,7 @@ def delete_pump(pump_id: str, db: Session):
         return False
     existing_pump.delete(synchronize_session=False)
     db.commit()
+    cache.invalidate_device(pump_id)
     return True
 
 # Handle Valves
@@ -100,23 +123,27 @@ def create_valve(db: Session, valve: schema.AddValve):
 def update_valve(db: Session, valve: schema.UpdateValve, valve_id: str):
     valve_query = db.query(models.Valve).filter(
         models.Valve.valve_id == valve_id)
-    if not valve_query.first():
+    existing_valve = valve_query.first()
+    if not existing_valve:
         return False
     entry = valve.dict()
     entry['updated_at'] = datetime.now()
     valve_query.update(entry, synchronize_session=False)
     db.commit()
+    pubsub.publish_valve(system_id=existing_valve.system_id, valve_id=valve_id, status=valve.status)
     return True
 
 def update_valve_status(db: Session, valve: schema.UpdateValveStatus, valve_id: str):
     valve_query = db.query(models.Valve).filter(
         models.Valve.valve_id == valve_id)
-    if not valve_query.first():
+    existing_valve = valve_query.first()
+    if not existing_valve:
         return False
     entry = valve.dict()
     entry['updated_at'] = datetime.now()
     valve_query.update(entry, synchronize_session=False)
     db.commit()
+    pubsub.publish_valve(system_id=existing_valve.system_id, valve_id=valve_id, status=valve.status)
     return True
 
 def delete_valve(valve_id: str, db: Session):
@@ -124,16 +151,9 @@ def delete_valve(valve_id: str, db: Session):
         models.Valve.valve_id == valve_id)
     if not existing_valve.first():
         return False
-    existing_valve.delete(synchronize_session=False)
-    db.commit()
-    print(f"Valve {valve_id} was deleted.")
-    existing_section = db.query(models.Section).filter(
-        models.Section.valve_id == valve_id)
-    while existing_section.first():
-        existing_section.delete(synchronize_session=False)
-        db.commit()
-        print(f"Deleting shift section with valveID: {valve_id}...")
-    return True
+    sections = select(models.Section.id).where(models.Section.valve_id == valve_id)
+    return run_deletes(db=db, steps=section_delete_steps(sections=sections) + [
+        (models.Valve, models.Valve.valve_id == valve_id, models.Valve.valve_id)])
 
 # Handle sensors
 def get_sensors(db: Session, skip: int = 0, limit: int = 50):
@@ -170,6 +190,7 @@ def delete_sensor(sensor_id: str, db: Session):
         return False
     existing_sensor.delete(synchronize_session=False)
     db.commit()
+    cache.invalidate_device(sensor_id)
     return True
 
 # Handle shifts
@@ -180,7 +201,8 @@ def get_shift(db: Session, shift_id: int):
     return db.query(models.Shift).filter(models.Shift.id == shift_id).first()
 
 def get_system_shifts(db: Session, system_id: int):
-    return db.query(models.Shift).filter(models.Shift.system_id == system_id).all()
+    return db.query(models.Shift).options(*shift_tree()).filter(
+        models.Shift.system_id == system_id).all()
 
 def create_shift(db: Session, shift: schema.AddShift):
     db_shift = models.Shift(**shift.dict())
@@ -192,18 +214,9 @@ def create_shift(db: Session, shift: schema.AddShift):
 def delete_shift(shift_id: int, db: Session):
     existing_shift = db.query(models.Shift).filter(models.Shift.id == shift_id)
     if not existing_shift.first():
-        print("No shift found!")
         return False
-    existing_shift.delete(synchronize_session=False)
-    db.commit()
-    print(f"Shift {shift_id} was deleted.")
-    existing_timer_controler = db.query(models.Timer).filter(
-        models.Timer.shift_id == shift_id)
-    while existing_timer_controler.first():
-        existing_timer_controler.delete(synchronize_session=False)
-        db.commit()
-        print(f"Deleting timer for shift {shift_id}...")
-    return True
+    shifts = select(models.Shift.id).where(models.Shift.id == shift_id)
+    return run_deletes(db=db, steps=shift_delete_steps(shifts=shifts))
 
 def update_shift(db: Session, shift: schema.UpdateShift, shift_id: int):
     shift_query = db.query(models.Shift).filter(models.Shift.id == shift_id)
@@ -224,23 +237,20 @@ def get_sections(db: Session, skip: int = 0, limit: int = 50):
 def get_section(id: int, db: Session):
     return db.query(models.Section).filter(models.Section.id == id).first()
 
-def check_for_valve_in_sections(db: Session, shift_id: int):
-    available_valves = []
-    system_id = get_shift(db=db, shift_id=shift_id)
-    system_valves = get_system_valves(db=db, system_id=system_id.system_id)
-    for valve in system_valves:
-        available_valves.append(valve.valve_id)
-    section_valves = []
-    for valve_id in available_valves:
-        section_valve = db.query(models.Section).filter(
-            models.Section.valve_id == valve_id).first()
-        if section_valve:
-            section_valves.append(section_valve.valve_id)
-    ready_valves = []
-    for valve in available_valves:
-        if valve not in section_valves:
-            ready_valves.append(valve)
-    return ready_valves
+# Valves of the shift's system that no section uses yet
+def available_valves_query(db: Session, shift_id: int):
+    assigned = select(models.Section.id).where(models.Section.valve_id == models.Valve.valve_id)
+    return db.query(models.Valve.valve_id).join(
+        models.Shift, models.Shift.system_id == models.Valve.system_id).filter(
+        models.Shift.id == shift_id, ~assigned.exists())
+
+def get_available_valves(db: Session, shift_id: int):
+    return [valve_id for valve_id, in available_valves_query(db=db, shift_id=shift_id).order_by(
+        models.Valve.valve_id)]
+
+def is_valve_available(db: Session, shift_id: int, valve_id: str):
+    return available_valves_query(db=db, shift_id=shift_id).filter(
+        models.Valve.valve_id == valve_id).first() is not None
 
 def create_section(db: Session, section: schema.SectionCreate):
     db_section = models.Section(**section.dict())
@@ -263,18 +273,9 @@ def change_section(db: Session, section: schema.SectionUpdate, id: int):
 def delete_section(id: int, db: Session):
     existing_section = db.query(models.Section).filter(models.Section.id == id)
     if not existing_section.first():
-        print(f"No section with ID:{id} has found!")
         return False
-    existing_section.delete(synchronize_session=False)
-    db.commit()
-    print(f"Deleting section ID:{id}...")
-    existing_sesor_controler = db.query(models.SensorControler).filter(
-        models.SensorControler.section_id == id)
-    while existing_sesor_controler.first():
-        existing_sesor_controler.delete(synchronize_session=False)
-        db.commit()
-        print(f"Deleting sensor controlers for section ID:{id}....")
-    return True
+    sections = select(models.Section.id).where(models.Section.id == id)
+    return run_deletes(db=db, steps=section_delete_steps(sections=sections))
 
 def get_sensor_controler(id: int, db: Session):
     return db.query(models.SensorControler).filter(
@@ -321,6 +322,13 @@ def get_timers(db: Session, shift_id: int):
 def get_all_timers(db: Session, skip: int = 0, limit: int = 50):
     return db.query(models.Timer).offset(skip).limit(limit).all()
 
+def get_system_timers(db: Session, system_id: int, exclude_id: Optional[int] = None):
+    query = db.query(models.Timer).join(models.Shift, models.Shift.id == models.Timer.shift_id).filter(
+        models.Shift.system_id == system_id)
+    if exclude_id is not None:
+        query = query.filter(models.Timer.id != exclude_id)
+    return query.all()
+
 def add_new_timer(db: Session, tcontroler: schema.TimerControl):
     db_controler = models.Timer(**tcontroler.dict())
     db.add(db_controler)
@@ -328,34 +336,6 @@ def add_new_timer(db: Session, tcontroler: schema.TimerControl):
     db.refresh(db_controler)
     return db_controler
 
-def parse_time(time_str):
-    return datetime.strptime(time_str, "%H:%M:%S").time()
-
-def do_timers_interfere(timer1, timer2):
-    days_of_week = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
-
-    # Check if any of the days in timer1 overlap with timer2
-    for day in days_of_week:
-        if timer1[day] and timer2[day]:
-            start_time1 = parse_time(timer1["starts"])
-            stop_time1 = parse_time(timer1["stops"])
-            start_time2 = parse_time(timer2["starts"])
-            stop_time2 = parse_time(timer2["stops"])
-
-            # Check if the time ranges overlap (taking into account start time equals end time)
-            if (
-                (start_time1 < stop_time1 and start_time2 < stop_time2 and
-                 ((start_time1 <= start_time2 < stop_time1) or
-                  (start_time1 < stop_time2 <= stop_time1) or
-                  (start_time2 <= start_time1 < stop_time2) or
-                  (start_time2 < stop_time1 <= stop_time2))) or
-                (start_time1 == stop_time1 and start_time2 == stop_time2 and
-                 start_time1 == start_time2)
-            ):
-                return True
-            else:
-                return False
-
 def change_timer_settings(db: Session, tcontroler: schema.TimerUpdate, id: int):
     controler_query = db.query(models.Timer).filter(
         models.Timer.id == id)
@@ -379,19 +359,9 @@ def delete_timer(id: int, db: Session):
 def get_logs(db: Session, skip: int = 0, limit: int = 50):
     return db.query(models.Logs).offset(skip).limit(limit).all()
 
-def get_dev_logs(db: Session, dev_id: str):
-    return db.query(models.Logs).filter(models.Logs.dev_id == dev_id).all()
-
 def get_log(db: Session, log_id: int):
     return db.query(models.Logs).filter(models.Logs.id == log_id).first()
 
-def create_log(db: Session, log: schema.LogCreate):
-    db_log = models.Logs(**log.dict())
-    db.add(db_log)
-    db.commit()
-    db.refresh(db_log)
-    return db_log
-
 def update_log(db: Session, log: schema.UpdateLog, log_id: int):
     log_query = db.query(models.Logs).filter(models.Logs.id == log_id)
     if not log_query.first():
@@ -408,6 +378,185 @@ def delete_log(log_id: int, db: Session):
     db.commit()
     return True
 
+# Handle batched device data
+MAX_BATCH_SIZE = 1000
+
+# Handle paginated device history
+HISTORY_PAGE_SIZE = 500
+MAX_HISTORY_PAGE_SIZE = 1000
+
+def encode_cursor(date: datetime, id: int):
+    return base64.urlsafe_b64encode(f"{date.isoformat()}|{id}".encode()).decode()
+
+def decode_cursor(cursor: str):
+    # Raises ValueError for anything that wasn't produced by encode_cursor
+    date, id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+    return datetime.fromisoformat(date), int(id)
+
+def paginate_by_date(query, model, date_from: Optional[datetime], date_to: Optional[datetime],
+                     after: Optional[Tuple[datetime, int]], limit: int):
+    if date_from:
+        query = query.filter(model.date >= date_from)
+    if date_to:
+        query = query.filter(model.date < date_to)
+    if after:
+        query = query.filter(tuple_(model.date, model.id) > tuple_(*after))
+    rows = query.order_by(model.date, model.id).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = encode_cursor(date=rows[limit - 1].date, id=rows[limit - 1].id)
+    return rows[:limit], next_cursor
+
+def get_flow_data_page(db: Session, pump_id: str, date_from: Optional[datetime] = None,
+                       date_to: Optional[datetime] = None, after: Optional[Tuple[datetime, int]] = None,
+                       limit: int = HISTORY_PAGE_SIZE):
+    return paginate_by_date(query=get_all_flow_data(db=db, pump_id=pump_id), model=models.FlowData,
+                            date_from=date_from, date_to=date_to, after=after, limit=limit)
+
+def get_sensor_data_page(db: Session, sensor_id: str, date_from: Optional[datetime] = None,
+                         date_to: Optional[datetime] = None, after: Optional[Tuple[datetime, int]] = None,
+                         limit: int = HISTORY_PAGE_SIZE):
+    return paginate_by_date(query=get_all_sensor_data(db=db, sensor_id=sensor_id), model=models.SensorData,
+                            date_from=date_from, date_to=date_to, after=after, limit=limit)
+
+# Handle cascade deletes
+# Steps are (model, condition, device key), children before their parents.
+# Everything runs in one transaction and the rows removed per table are returned.
+def run_deletes(db: Session, steps: list):
+    deleted = {}
+    devices = []
+    for model, condition, key in steps:
+        stmt = delete(model).where(condition).execution_options(synchronize_session=False)
+        if key is not None:
+            ids = db.execute(stmt.returning(key)).scalars().all()
+            devices.extend(ids)
+            count = len(ids)
+        else:
+            count = db.execute(stmt).rowcount
+        deleted[model.__tablename__] = deleted.get(model.__tablename__, 0) + count
+    db.commit()
+    for dev_id in devices:
+        cache.invalidate_device(dev_id)
+    return deleted
+
+def section_delete_steps(sections):
+    return [
+        (models.SensorControler, models.SensorControler.section_id.in_(sections), None),
+        (models.Section, models.Section.id.in_(sections), None),
+    ]
+
+def shift_delete_steps(shifts):
+    sections = select(models.Section.id).where(models.Section.shift_id.in_(shifts))
+    return section_delete_steps(sections=sections) + [
+        (models.Timer, models.Timer.shift_id.in_(shifts), None),
+        (models.Shift, models.Shift.id.in_(shifts), None),
+    ]
+
+def system_delete_steps(system_id: int):
+    shifts = select(models.Shift.id).where(models.Shift.system_id == system_id)
+    valves = select(models.Valve.valve_id).where(models.Valve.system_id == system_id)
+    sensors = select(models.Sensor.sensor_id).where(models.Sensor.system_id == system_id)
+    pumps = select(models.Pump.pump_id).where(models.Pump.system_id == system_id)
+    # Sections of other systems' shifts can still point at this system's valves
+    sections = select(models.Section.id).where(or_(
+        models.Section.shift_id.in_(shifts), models.Section.valve_id.in_(valves)))
+    return section_delete_steps(sections=sections) + [
+        (models.Timer, models.Timer.shift_id.in_(shifts), None),
+        (models.Shift, models.Shift.system_id == system_id, None),
+        (models.LastSensorData, models.LastSensorData.sensor_id.in_(sensors), None),
+        (models.SensorData, models.SensorData.sensor_id.in_(sensors), None),
+        (models.Sensor, models.Sensor.system_id == system_id, models.Sensor.sensor_id),
+        (models.LastFlowData, models.LastFlowData.pump_id.in_(pumps), None),
+        (models.FlowData, models.FlowData.pump_id.in_(pumps), None),
+        (models.Pump, models.Pump.system_id == system_id, models.Pump.pump_id),
+        (models.Valve, models.Valve.system_id == system_id, models.Valve.valve_id),
+        (models.System, models.System.id == system_id, None),
+    ]
+
+# Handle device registry
+def device_kind_query(dev_id: str):
+    return union_all(
+        select(literal("pump")).where(models.Pump.pump_id == dev_id),
+        select(literal("valve")).where(models.Valve.valve_id == dev_id),
+        select(literal("sensor")).where(models.Sensor.sensor_id == dev_id),
+    ).limit(1)
+
+async def async_get_device_kind(db: AsyncSession, dev_id: str):
+    kind = cache.get_device_kind(dev_id)
+    if kind is None:
+        kind = (await db.execute(device_kind_query(dev_id=dev_id))).scalar()
+        # Only known devices are cached, new devices are found right away
+        if kind:
+            cache.set_device_kind(dev_id, kind)
+    return kind
+
+# Handle system logs
+DEVICE_KINDS = ["pump", "valve", "sensor"]
+
+def system_devices(system_id: int):
+    return union_all(
+        select(models.Pump.pump_id.label("dev_id"), literal("pump").label("kind")).where(
+            models.Pump.system_id == system_id),
+        select(models.Valve.valve_id.label("dev_id"), literal("valve").label("kind")).where(
+            models.Valve.system_id == system_id),
+        select(models.Sensor.sensor_id.label("dev_id"), literal("sensor").label("kind")).where(
+            models.Sensor.system_id == system_id),
+    ).subquery()
+
+def get_system_logs_by_kind(db: Session, system_id: int):
+    devices = system_devices(system_id=system_id)
+    rows = db.query(models.Logs, devices.c.kind).join(
+        devices, devices.c.dev_id == models.Logs.dev_id).order_by(models.Logs.date, models.Logs.id)
+    logs = {kind: [] for kind in DEVICE_KINDS}
+    for log, kind in rows:
+        logs[kind].append(log)
+    return logs
+
+def get_system_logs_page(db: Session, system_id: int, date_from: Optional[datetime] = None,
+                         date_to: Optional[datetime] = None, disable: Optional[bool] = None,
+                         after: Optional[Tuple[datetime, int]] = None, limit: int = HISTORY_PAGE_SIZE):
+    devices = system_devices(system_id=system_id)
+    # Each device's first page comes from the (dev_id, date) index and only
+    # those rows are merged, the system's whole history is never sorted
+    query = db.query(models.Logs).filter(models.Logs.dev_id == devices.c.dev_id)
+    if disable is not None:
+        query = query.filter(models.Logs.disable == disable)
+    if date_from:
+        query = query.filter(models.Logs.date >= date_from)
+    if date_to:
+        query = query.filter(models.Logs.date < date_to)
+    if after:
+        query = query.filter(tuple_(models.Logs.date, models.Logs.id) > tuple_(*after))
+    per_device = query.order_by(models.Logs.date, models.Logs.id).limit(limit + 1).subquery().lateral()
+    logs = aliased(models.Logs, per_device)
+    return paginate_by_date(query=db.query(logs).select_from(devices).join(logs, true()), model=logs,
+                            date_from=None, date_to=None, after=None, limit=limit)
+
+# Handle latest device readings
+def get_last_flow_data(db: Session, pump_id: str):
+    return db.get(models.LastFlowData, pump_id)
+
+def get_last_sensor_data(db: Session, sensor_id: str):
+    return db.get(models.LastSensorData, sensor_id)
+
+def get_system_last_flow_data(db: Session, system_id: int):
+    return db.query(models.LastFlowData).join(
+        models.Pump, models.Pump.pump_id == models.LastFlowData.pump_id).filter(
+        models.Pump.system_id == system_id).all()
+
+def get_system_last_sensor_data(db: Session, system_id: int):
+    return db.query(models.LastSensorData).join(
+        models.Sensor, models.Sensor.sensor_id == models.LastSensorData.sensor_id).filter(
+        models.Sensor.system_id == system_id).all()
+
+def last_data_upsert(model, key: str, rows: List[dict]):
+    # Rows must hold at most one entry per device, Postgres can't update a row twice.
+    # Sorted so concurrent batches lock the rows in the same order.
+    stmt = pg_insert(model).values(sorted(rows, key=lambda row: row[key]))
+    columns = [column.name for column in model.__table__.columns if column.name != key]
+    return stmt.on_conflict_do_update(
+        index_elements=[key], set_={column: stmt.excluded[column] for column in columns})
+
 # Handle flow data
 def get_flow_data(db: Session, pump_id: str):
     return db.query(models.FlowData).order_by(models.FlowData.pump_id, models.FlowData.date.desc()).filter(
@@ -416,21 +565,29 @@ def get_flow_data(db: Session, pump_id: str):
 def get_all_flow_data(db: Session, pump_id: str):
     return db.query(models.FlowData).filter(models.FlowData.pump_id == pump_id)
 
-def create_flow_data(db: Session, flow: schema.AddFlowData):
-    db_data = models.FlowData(**flow.dict())
-    db.add(db_data)
-    db.commit()
-    db.refresh(db_data)
-    return db_data
-
-def update_pump_data(db: Session, pump_id: str, current: float):
-    query_pump = db.query(models.Pump).filter(models.Pump.pump_id == pump_id)
-    if not query_pump.first():
-        return False
-    query_pump.update({models.Pump.current: current},
-                      synchronize_session=False)
-    db.commit()
-    return True
+def pump_volume_decrement(pump_id: str, amount: float):
+    # Computed by the database so concurrent samples can't overwrite each other
+    return update(models.Pump).where(models.Pump.pump_id == pump_id).values(
+        current=models.Pump.current - amount).execution_options(synchronize_session=False)
+
+def plan_flow_data_batch(pumps: set, records: List[schema.AddFlowData]):
+    results = []
+    rows = []
+    latest = {}
+    totals = {}
+    for index, record in enumerate(records):
+        if record.pump_id not in pumps:
+            results.append(schema.BatchResult(
+                index=index, device_id=record.pump_id, accepted=False,
+                detail="There is no such pump. Please check device ID"))
+            continue
+        rows.append(record.dict())
+        latest[record.pump_id] = record.dict()
+        totals[record.pump_id] = totals.get(record.pump_id, 0) + record.flow_rate
+        results.append(schema.BatchResult(
+            index=index, device_id=record.pump_id, accepted=True,
+            detail="Successfully updated pump volume"))
+    return results, rows, latest, totals
 
 # Handle sensor data
 def get_sensor_data(db: Session, sensor_id: str):
@@ -440,23 +597,164 @@ def get_sensor_data(db: Session, sensor_id: str):
 def get_all_sensor_data(db: Session, sensor_id: str):
     return db.query(models.SensorData).filter(models.SensorData.sensor_id == sensor_id)
 
-def create_sensor_data(db: Session, sensor: schema.AddSensorData):
-    db_data = models.SensorData(**sensor.dict())
-    db.add(db_data)
-    db.commit()
-    db.refresh(db_data)
-    return db_data
-
-def update_sensor_data(db: Session, sensor_id: str, readings: float, temp: float):
-    query_readings = db.query(models.Sensor).filter(
-        models.Sensor.sensor_id == sensor_id)
-    if not query_readings.first():
+def compute_sensor_readings(sensor: models.Sensor, data: schema.AddSensorData):
+    moisture = {"level_1": data.level_1,
+                "level_2": data.level_2, "level_3": data.level_3}
+    temp = {"level_1": data.temp_1,
+            "level_2": data.temp_2, "level_3": data.temp_3}
+    settings = {"level_1": sensor.set_lvl_1,
+                "level_2": sensor.set_lvl_2, "level_3": sensor.set_lvl_3}
+    user_setup = [f"level_{i}" for i in range(1, 4) if settings[f"level_{i}"]]
+    y = len(user_setup)
+    new_readings = 0
+    for i in user_setup:
+        new_readings += moisture[i]/y
+    new_temp = 0
+    for j in user_setup:
+        new_temp += temp[j]/y
+    return new_readings, new_temp
+
+def plan_sensor_data_batch(sensors: dict, records: List[schema.AddSensorData]):
+    results = []
+    rows = []
+    latest = {}
+    readings = {}
+    for index, record in enumerate(records):
+        sensor = sensors.get(record.sensor_id)
+        if not sensor:
+            results.append(schema.BatchResult(
+                index=index, device_id=record.sensor_id, accepted=False,
+                detail="There is no such sensor. Please check device ID"))
+            continue
+        rows.append(record.dict())
+        # Later records in the payload are newer, so they overwrite earlier ones
+        new_readings, new_temp = compute_sensor_readings(sensor=sensor, data=record)
+        readings[record.sensor_id] = {"sensor_id": record.sensor_id,
+                                      "readings": new_readings, "temp": new_temp}
+        latest[record.sensor_id] = record.dict()
+        results.append(schema.BatchResult(
+            index=index, device_id=record.sensor_id, accepted=True,
+            detail="Successfully updated sensor readings"))
+    return results, rows, readings, latest
+
+# Async handlers for device API
+async def async_get_system(db: AsyncSession, system_id: int):
+    return await db.get(models.System, system_id)
+
+async def async_get_system_valves(db: AsyncSession, system_id: int):
+    result = await db.execute(select(models.Valve).filter(models.Valve.system_id == system_id))
+    return result.scalars().all()
+
+async def async_update_valve_status(db: AsyncSession, valve: schema.UpdateValveStatus, valve_id: str):
+    entry = valve.dict()
+    entry['updated_at'] = datetime.now()
+    result = await db.execute(update(models.Valve).where(models.Valve.valve_id == valve_id).values(
+        **entry).returning(models.Valve.system_id).execution_options(synchronize_session=False))
+    system_id = result.scalar_one_or_none()
+    await db.commit()
+    if system_id is None:
         return False
-    query_readings.update(
-        {models.Sensor.readings: readings, models.Sensor.temp: temp}, synchronize_session=False)
-    db.commit()
+    pubsub.publish_valve(system_id=system_id, valve_id=valve_id, status=valve.status)
     return True
 
+async def async_create_flow_data_batch(db: AsyncSession, records: List[schema.AddFlowData]):
+    pump_ids = {record.pump_id for record in records}
+    result = await db.execute(select(models.Pump.pump_id, models.Pump.system_id).filter(
+        models.Pump.pump_id.in_(pump_ids)))
+    systems = {pump_id: system_id for pump_id, system_id in result}
+    results, rows, latest, totals = plan_flow_data_batch(pumps=set(systems), records=records)
+    if rows:
+        await db.execute(insert(models.FlowData), rows)
+        # Same lock order in every transaction keeps concurrent batches from deadlocking
+        for pump_id in sorted(totals):
+            await db.execute(pump_volume_decrement(pump_id=pump_id, amount=totals[pump_id]))
+        await db.execute(last_data_upsert(model=models.LastFlowData,
+                                          key="pump_id", rows=list(latest.values())))
+        await db.commit()
+        pubsub.publish_data(systems=systems, kind="flowdata", key="pump_id", rows=rows)
+    return results
+
+async def async_create_sensor_data_batch(db: AsyncSession, records: List[schema.AddSensorData]):
+    sensor_ids = {record.sensor_id for record in records}
+    result = await db.execute(select(models.Sensor).filter(models.Sensor.sensor_id.in_(sensor_ids)))
+    sensors = {sensor.sensor_id: sensor for sensor in result.scalars()}
+    results, rows, readings, latest = plan_sensor_data_batch(sensors=sensors, records=records)
+    if rows:
+        await db.execute(insert(models.SensorData), rows)
+        # Same lock order in every transaction keeps concurrent batches from deadlocking
+        await db.execute(update(models.Sensor), [readings[sensor_id] for sensor_id in sorted(readings)])
+        await db.execute(last_data_upsert(model=models.LastSensorData,
+                                          key="sensor_id", rows=list(latest.values())))
+        systems = {sensor_id: sensor.system_id for sensor_id, sensor in sensors.items()}
+        await db.commit()
+        pubsub.publish_data(systems=systems, kind="sensordata", key="sensor_id", rows=rows)
+    return results
+
+# Handle section evaluation
+def section_moisture_query(system_id: int):
+    return select(
+        models.Section.id.label("section_id"), models.Section.valve_id,
+        models.Section.sensors_settings, models.Section.starts_at, models.Section.stops_at,
+        models.Valve.status,
+        func.avg(models.Sensor.readings).label("average"),
+        func.min(models.Sensor.readings).label("minimum"),
+        func.max(models.Sensor.readings).label("maximum"),
+        func.count(models.Sensor.readings).label("sensors"),
+        func.max(models.LastSensorData.date).label("last_reading"),
+    ).select_from(models.Section).join(
+        models.Shift, models.Shift.id == models.Section.shift_id).outerjoin(
+        models.Valve, models.Valve.valve_id == models.Section.valve_id).outerjoin(
+        models.SensorControler, models.SensorControler.section_id == models.Section.id).outerjoin(
+        models.Sensor, models.Sensor.sensor_id == models.SensorControler.sensor_id).outerjoin(
+        models.LastSensorData, models.LastSensorData.sensor_id == models.Sensor.sensor_id).where(
+        models.Shift.system_id == system_id).group_by(
+        models.Section.id, models.Valve.valve_id).order_by(models.Section.id)
+
+async def async_get_section_moisture(db: AsyncSession, system_id: int):
+    result = await db.execute(section_moisture_query(system_id=system_id))
+    return result.all()
+
+# Handle aggregated sensor data
+AGGREGATE_BUCKETS = ["minute", "hour", "day"]
+AGGREGATE_FIELDS = ["level_1", "level_2", "level_3", "temp_1", "temp_2", "temp_3", "moisture", "bat_level"]
+MAX_AGGREGATE_BUCKETS = 1000
+
+def get_sensor_data_aggregates(db: Session, sensor_id: str, bucket: str, date_from: Optional[datetime] = None,
+                               date_to: Optional[datetime] = None, after: Optional[Tuple[datetime, int]] = None,
+                               limit: int = MAX_AGGREGATE_BUCKETS):
+    if bucket not in AGGREGATE_BUCKETS:
+        raise ValueError(f"Unsupported bucket: {bucket}")
+    # Rendered inline, with a bound parameter Postgres can't match the GROUP BY to the select list
+    period = func.date_trunc(literal_column(f"'{bucket}'"), models.SensorData.date)
+    columns = [period.label("bucket"), func.count(models.SensorData.id).label("count")]
+    for field in AGGREGATE_FIELDS:
+        column = getattr(models.SensorData, field)
+        columns += [func.min(column).label(f"{field}_min"),
+                    func.max(column).label(f"{field}_max"),
+                    func.avg(column).label(f"{field}_avg")]
+    query = db.query(*columns).filter(models.SensorData.sensor_id == sensor_id)
+    if date_from:
+        query = query.filter(models.SensorData.date >= date_from)
+    if date_to:
+        query = query.filter(models.SensorData.date < date_to)
+    if after:
+        # Later buckets start after the cursor, the date filter keeps the index usable
+        query = query.filter(models.SensorData.date >= after[0], period > after[0])
+    rows = query.group_by(period).order_by(period).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        # Buckets are unique, the id part of the cursor is unused
+        next_cursor = encode_cursor(date=rows[limit - 1].bucket, id=0)
+    aggregates = []
+    for row in rows[:limit]:
+        entry = {"bucket": row.bucket, "count": row.count}
+        for field in AGGREGATE_FIELDS:
+            entry[field] = {"min": getattr(row, f"{field}_min"),
+                            "max": getattr(row, f"{field}_max"),
+                            "avg": getattr(row, f"{field}_avg")}
+        aggregates.append(entry)
+    return aggregates, next_cursor
+
 # Handling users
 def get_user(db: Session, username: str):
     user = db.query(models.User).filter(models.User.username == username).first()
@@ -466,47 +764,9 @@ def get_user_email(db: Session, email: str):
     user = db.query(models.User).filter(models.User.email == email).first()
     return user
 
-def get_user_by_secret(db: Session, secret: str):
-    user = db.query(models.User).filter(models.User.secret == secret).first()
-    return user
-
 def get_users(db: Session, skip: int = 0, limit: int = 50):
-    return db.query(models.User).offset(skip).limit(limit).all()
-
-def create_user(db: Session, user: schema.UserCreate):
-    db_user = models.User(email=user.email, username = user.username, hashed_password=config.get_hashed_password(user.password), 
-        name=user.name, surname=user.surname, address=user.address, admin=user.admin, premium=user.premium, delisted=user.delisted, 
-        secret=config.generate_secret())
-    if db_user.username == "admin":
-        db_user.delisted = False
-        db_user.admin = True
-    db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
-    return db_user
-
-def change_password(db: Session, username: str, password: schema.LostPassword):
-    pwd_query = db.query(models.User).filter(models.User.username == username)
-    if not pwd_query.first():
-        return False
-    hashed_pwd = config.get_hashed_password(password.password)
-    pwd_query.update({models.User.hashed_password: hashed_pwd}, synchronize_session=False)
-    db.commit()
-    return True
-
-def reset_password(db: Session, password: schema.ResetPassword):
-    reset_query = db.query(models.User).filter(models.User.secret == password.secret)
-    if not reset_query.first():
-        return False
-    hashed_pwd = config.get_hashed_password(password.password)
-    reset_query.update(
-        {
-            models.User.hashed_password: hashed_pwd,
-            models.User.secret: config.generate_secret()
-        }, 
-        synchronize_session=False)
-    db.commit()
-    return True
+    return db.query(models.User).options(*user_tree()).order_by(
+        models.User.username).offset(skip).limit(limit).all()
 
 def update_user(db: Session, username: str, user: schema.UserUpdate):
     user_query = db.query(models.User).filter(models.User.username == username)
@@ -516,6 +776,7 @@ def update_user(db: Session, username: str, user: schema.UserUpdate):
     entry['updated_at'] = datetime.now()
     user_query.update(entry, synchronize_session=False)
     db.commit()
+    cache.invalidate_principal(username)
     return True
 
 def admin_update_user(db: Session, username: str, user: schema.AdminUserUpdate):
@@ -524,6 +785,7 @@ def admin_update_user(db: Session, username: str, user: schema.AdminUserUpdate):
         return False
     user_query.update(user.dict(), synchronize_session=False)
     db.commit()
+    cache.invalidate_principal(username)
     return True
 
 def delete_user(username: str , db: Session):
@@ -532,31 +794,166 @@ def delete_user(username: str , db: Session):
         return False
     existing_user.delete(synchronize_session=False)
     db.commit()
+    cache.invalidate_principal(username)
     return True
 
+# Async user handlers, password hashes are computed by the caller
+async def async_get_user(db: AsyncSession, username: str):
+    return await db.get(models.User, username)
+
+async def async_get_user_email(db: AsyncSession, email: str):
+    result = await db.execute(select(models.User).filter(models.User.email == email))
+    return result.scalars().first()
+
+async def async_get_user_by_secret(db: AsyncSession, secret: str):
+    result = await db.execute(select(models.User).filter(models.User.secret == secret))
+    return result.scalars().first()
+
+async def async_create_user(db: AsyncSession, user: schema.UserCreate, hashed_password: str):
+    db_user = models.User(email=user.email, username = user.username, hashed_password=hashed_password, 
+        name=user.name, surname=user.surname, address=user.address, admin=user.admin, premium=user.premium, delisted=user.delisted, 
+        secret=config.generate_secret())
+    if db_user.username == "admin":
+        db_user.delisted = False
+        db_user.admin = True
+    db.add(db_user)
+    await db.commit()
+    return db_user
+
+async def async_change_password(db: AsyncSession, username: str, hashed_password: str):
+    result = await db.execute(update(models.User).where(models.User.username == username).values(
+        hashed_password=hashed_password).execution_options(synchronize_session=False))
+    await db.commit()
+    return result.rowcount > 0
+
+async def async_reset_password(db: AsyncSession, secret: str, hashed_password: str):
+    result = await db.execute(update(models.User).where(models.User.secret == secret).values(
+        hashed_password=hashed_password, secret=config.generate_secret()).execution_options(
+        synchronize_session=False))
+    await db.commit()
+    return result.rowcount > 0
+
 #Handle login
-def get_current_user(db: Session = Depends(db.get_db), token: str=Depends(config.security)):
+def get_current_user(token: str=Depends(config.security), session: Session = Depends(db.get_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     token_data = config.verify_token(token, credentials_exception)  
-    current_user = get_user(db, username=token_data.username)
-    if current_user is None:
+    current_user = cache.get_principal(token_data.username)
+    if current_user is not None:
+        return current_user
+    # The request's session is lazy, only a cache miss takes a connection.
+    # It is released again so async routes don't hold it while they await.
+    db_user = get_user(session, username=token_data.username)
+    if db_user is None:
         raise credentials_exception    
+    current_user = schema.Principal.model_validate(db_user)
+    session.close()
+    cache.set_principal(token_data.username, current_user)
     return current_user
 
-def validate_user(db: Session, user: schema.Login):
-    db_user = get_user(db=db, username=user.username)
+async def async_validate_user(db: AsyncSession, user: schema.Login):
+    db_user = await async_get_user(db=db, username=user.username)
     if not db_user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
         )   
-    if not config.verify_password(user.password, db_user.hashed_password):
+    # Don't hold a connection while the hash waits for the process pool
+    await db.close()
+    if not await hashing.verify_password(user.password, db_user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
         )
-    return db_user
\ No newline at end of file
+    return db_user
+
+# Handle ownership checks
+SHIFT_JOIN = (models.Shift, models.Shift.system_id == models.System.id)
+SECTION_JOIN = (models.Section, models.Section.shift_id == models.Shift.id)
+
+OWNERSHIP_PATHS = {
+    "system": ([], models.System.id),
+    "pump": ([(models.Pump, models.Pump.system_id == models.System.id)], models.Pump.pump_id),
+    "valve": ([(models.Valve, models.Valve.system_id == models.System.id)], models.Valve.valve_id),
+    "sensor": ([(models.Sensor, models.Sensor.system_id == models.System.id)], models.Sensor.sensor_id),
+    "shift": ([SHIFT_JOIN], models.Shift.id),
+    "section": ([SHIFT_JOIN, SECTION_JOIN], models.Section.id),
+    "timer": ([SHIFT_JOIN, (models.Timer, models.Timer.shift_id == models.Shift.id)], models.Timer.id),
+    "controler": ([SHIFT_JOIN, SECTION_JOIN,
+                   (models.SensorControler, models.SensorControler.section_id == models.Section.id)],
+                  models.SensorControler.id),
+}
+
+def get_owner(db: Session, resource: str, id):
+    joins, key = OWNERSHIP_PATHS[resource]
+    query = db.query(models.System.id.label("system_id"), models.System.owner)
+    for model, on in joins:
+        query = query.join(model, on)
+    return query.filter(key == id).first()
+
+def authorize(db: Session, current_user: schema.Principal, resource: str, id, allow_admin: bool = False):
+    owner = get_owner(db=db, resource=resource, id=id)
+    if not owner:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Could not found {resource} in database"
+        )
+    if current_user.username != owner.owner and not (allow_admin and current_user.admin):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="You are not authorized to update database"
+        )
+    return owner
+
+def owned(resource: str, param: str, allow_admin: bool = False):
+    def check_owner(request: Request, db: Session = Depends(db.get_db),
+                    current_user: schema.Principal = Depends(get_current_user)):
+        _, key = OWNERSHIP_PATHS[resource]
+        try:
+            id = key.type.python_type(request.path_params[param])
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Could not found {resource} in database"
+            )
+        return authorize(db=db, current_user=current_user, resource=resource,
+                         id=id, allow_admin=allow_admin)
+    return check_owner
+
+# Handle versions of polled system settings
+VERSION_SOURCES = {
+    "valves": [(models.Valve, [], models.Valve.system_id)],
+    "sensors": [(models.Sensor, [], models.Sensor.system_id)],
+    "shifts": [
+        (models.Shift, [], models.Shift.system_id),
+        (models.Section, [(models.Shift, models.Shift.id == models.Section.shift_id)], models.Shift.system_id),
+        (models.Timer, [(models.Shift, models.Shift.id == models.Timer.shift_id)], models.Shift.system_id),
+        (models.SensorControler, [(models.Section, models.Section.id == models.SensorControler.section_id),
+                                  (models.Shift, models.Shift.id == models.Section.shift_id)], models.Shift.system_id),
+    ],
+}
+
+def system_version_query(system_id: int, resource: str):
+    # Row counts are part of the version so deletes change it as well
+    columns = [select(func.count(models.System.id)).where(models.System.id == system_id).scalar_subquery()]
+    for model, joins, system_column in VERSION_SOURCES[resource]:
+        for aggregate in (func.max(model.updated_at), func.count()):
+            query = select(aggregate).select_from(model)
+            for join_model, on in joins:
+                query = query.join(join_model, on)
+            columns.append(query.where(system_column == system_id).scalar_subquery())
+    return select(*columns)
+
+def make_etag(row):
+    return 'W/"' + hashlib.sha1(repr(tuple(row[1:])).encode()).hexdigest()[:20] + '"'
+
+def get_system_version(db: Session, system_id: int, resource: str):
+    row = db.execute(system_version_query(system_id=system_id, resource=resource)).one()
+    return row[0] > 0, make_etag(row)
+
+async def async_get_system_version(db: AsyncSession, system_id: int, resource: str):
+    row = (await db.execute(system_version_query(system_id=system_id, resource=resource))).one()
+    return row[0] > 0, make_etag(row)
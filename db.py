@@ -1,22 +1,106 @@
 from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from threading import Lock
+import time
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
 from config import settings
 
 
 DATABASE_URL = f"postgresql://{settings.postgres_user}:{settings.postgres_password}@{settings.postgres_server}:{settings.postgres_port}/{settings.postgres_db_name}"
+ASYNC_DATABASE_URL = f"postgresql+asyncpg://{settings.postgres_user}:{settings.postgres_password}@{settings.postgres_server}:{settings.postgres_port}/{settings.postgres_db_name}"
 
-engine = create_engine(DATABASE_URL)
+POOL_OPTIONS = {
+    "pool_size": settings.db_pool_size,
+    "max_overflow": settings.db_max_overflow,
+    "pool_timeout": settings.db_pool_timeout,
+    "pool_recycle": settings.db_pool_recycle,
+    "pool_pre_ping": settings.db_pool_pre_ping,
+}
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+engine = None
+async_engine = None
+
+SessionLocal = sessionmaker(autocommit=False, autoflush=False)
+
+AsyncSessionLocal = async_sessionmaker(autoflush=False, expire_on_commit=False)
+
+# Pools time every checkout, sessions stay lazy and only take a connection
+# when they run their first statement
+class TimedQueuePool(QueuePool):
+    wait_name = "sync"
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            record_pool_wait(self.wait_name, time.perf_counter() - start)
+
+class TimedAsyncQueuePool(TimedQueuePool, AsyncAdaptedQueuePool):
+    wait_name = "async"
+
+# Engines are created in the app lifespan, so every worker process gets
+# its own pools instead of sharing connections inherited at import
+def init_engine():
+    global engine, async_engine
+    if engine is None:
+        engine = create_engine(DATABASE_URL, poolclass=TimedQueuePool, **POOL_OPTIONS)
+        SessionLocal.configure(bind=engine)
+    if async_engine is None:
+        async_engine = create_async_engine(ASYNC_DATABASE_URL, poolclass=TimedAsyncQueuePool, **POOL_OPTIONS)
+        AsyncSessionLocal.configure(bind=async_engine)
+
+async def dispose_engine():
+    global engine, async_engine
+    if async_engine is not None:
+        await async_engine.dispose()
+        async_engine = None
+    if engine is not None:
+        engine.dispose()
+        engine = None
 
 Base = declarative_base()
 
+# Time requests spend waiting for a pooled connection
+pool_waits = {"sync": {"count": 0, "total": 0.0, "max": 0.0},
+              "async": {"count": 0, "total": 0.0, "max": 0.0}}
+pool_waits_lock = Lock()
+
+def record_pool_wait(name: str, seconds: float):
+    with pool_waits_lock:
+        waits = pool_waits[name]
+        waits["count"] += 1
+        waits["total"] += seconds
+        waits["max"] = max(waits["max"], seconds)
+
+def pool_stats(name: str, pool):
+    with pool_waits_lock:
+        waits = dict(pool_waits[name])
+    return {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": max(0, pool.overflow()),
+        "max_overflow": settings.db_max_overflow,
+        "wait_count": waits["count"],
+        "wait_avg": waits["total"] / waits["count"] if waits["count"] else 0.0,
+        "wait_max": waits["max"],
+    }
+
+def pool_status():
+    return {"sync": pool_stats("sync", engine.pool),
+            "async": pool_stats("async", async_engine.pool)}
     
 def get_db():
     db=SessionLocal()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -0,0 +1,33 @@
+"""time series indexes
+
+Revision ID: 14a24a90cd08
+Revises: 1de256f038fa
+Create Date: 2026-10-18 10:12:41.318204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '14a24a90cd08'
+down_revision: Union[str, None] = '1de256f038fa'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_sensor_data_sensor_id_date', 'sensor_data',
+                    ['sensor_id', sa.text('date DESC')], unique=False)
+    op.create_index('ix_flow_data_pump_id_date', 'flow_data',
+                    ['pump_id', sa.text('date DESC')], unique=False)
+    op.create_index('ix_logs_dev_id_date', 'logs',
+                    ['dev_id', 'date'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_logs_dev_id_date', table_name='logs')
+    op.drop_index('ix_flow_data_pump_id_date', table_name='flow_data')
+    op.drop_index('ix_sensor_data_sensor_id_date', table_name='sensor_data')
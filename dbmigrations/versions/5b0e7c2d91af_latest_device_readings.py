@@ -0,0 +1,61 @@
+"""latest device readings
+
+Revision ID: 5b0e7c2d91af
+Revises: 14a24a90cd08
+Create Date: 2026-10-18 11:03:27.904512
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5b0e7c2d91af'
+down_revision: Union[str, None] = '14a24a90cd08'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('last_flow_data',
+    sa.Column('pump_id', sa.String(length=25), nullable=False),
+    sa.Column('flow_rate', sa.Float(), nullable=True),
+    sa.Column('date', sa.TIMESTAMP(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.ForeignKeyConstraint(['pump_id'], ['pumps.pump_id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('pump_id')
+    )
+    op.create_table('last_sensor_data',
+    sa.Column('sensor_id', sa.String(length=25), nullable=False),
+    sa.Column('level_1', sa.Float(), nullable=True),
+    sa.Column('level_2', sa.Float(), nullable=True),
+    sa.Column('level_3', sa.Float(), nullable=True),
+    sa.Column('temp_1', sa.Float(), nullable=True),
+    sa.Column('temp_2', sa.Float(), nullable=True),
+    sa.Column('temp_3', sa.Float(), nullable=True),
+    sa.Column('temperature', sa.Float(), nullable=True),
+    sa.Column('moisture', sa.Float(), nullable=True),
+    sa.Column('bat_level', sa.Float(), nullable=True),
+    sa.Column('date', sa.TIMESTAMP(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.ForeignKeyConstraint(['sensor_id'], ['sensors.sensor_id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('sensor_id')
+    )
+    # Seed the tables with the newest sample already stored for every device
+    op.execute(
+        "INSERT INTO last_flow_data (pump_id, flow_rate, date) "
+        "SELECT DISTINCT ON (pump_id) pump_id, flow_rate, date "
+        "FROM flow_data ORDER BY pump_id, date DESC"
+    )
+    op.execute(
+        "INSERT INTO last_sensor_data (sensor_id, level_1, level_2, level_3, temp_1, temp_2, "
+        "temp_3, temperature, moisture, bat_level, date) "
+        "SELECT DISTINCT ON (sensor_id) sensor_id, level_1, level_2, level_3, temp_1, temp_2, "
+        "temp_3, temperature, moisture, bat_level, date "
+        "FROM sensor_data ORDER BY sensor_id, date DESC"
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('last_sensor_data')
+    op.drop_table('last_flow_data')
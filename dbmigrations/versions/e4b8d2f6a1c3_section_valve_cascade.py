@@ -0,0 +1,32 @@
+"""section valve cascade
+
+Revision ID: e4b8d2f6a1c3
+Revises: 9c3f4e1a7d20
+Create Date: 2026-10-18 16:12:41.538207
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e4b8d2f6a1c3'
+down_revision: Union[str, None] = '9c3f4e1a7d20'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Sections left behind by deleted valves would violate the new constraint
+    op.execute(
+        "DELETE FROM sections WHERE valve_id IS NOT NULL "
+        "AND NOT EXISTS (SELECT 1 FROM valves WHERE valves.valve_id = sections.valve_id)"
+    )
+    op.create_foreign_key('sections_valve_id_fkey', 'sections', 'valves',
+                          ['valve_id'], ['valve_id'], ondelete='CASCADE')
+
+
+def downgrade() -> None:
+    op.drop_constraint('sections_valve_id_fkey', 'sections', type_='foreignkey')
@@ -0,0 +1,54 @@
+from config import settings
+import cache
+
+# Which aggregate of the sensors' latest readings each rule compares:
+# AVG the mean, ONE waters as soon as one sensor is dry, ALL only once every
+# sensor is dry
+RULE_VALUES = {"AVG": "average", "ONE": "minimum", "ALL": "maximum"}
+
+# Results are cached per section with a stamp of every input of the
+# decision, the aggregates of the sensors' readings included, so only
+# sections whose sensors received new data or whose settings changed are
+# evaluated again. The stamp holds values, not just dates, so a reading
+# committed out of date order can't leave a stale decision behind.
+section_results = cache.MemoryCache()
+
+def section_stamp(row):
+    return (row.valve_id, row.sensors_settings, row.starts_at, row.stops_at, row.status,
+            row.average, row.minimum, row.maximum, row.sensors, row.last_reading)
+
+# Below starts_at the valve opens, from stops_at up it closes and in
+# between it keeps its current state, so it doesn't flap around one value
+def decide(value, starts_at: float, stops_at: float, status):
+    if value < starts_at:
+        return True, "Moisture is below start value"
+    if value >= stops_at:
+        return False, "Moisture reached stop value"
+    return bool(status), "Moisture is between start and stop values"
+
+def evaluate_section(row):
+    result = {"section_id": row.section_id, "valve_id": row.valve_id,
+              "sensors_settings": row.sensors_settings, "moisture": None,
+              "sensors": row.sensors, "status": row.status, "desired": None}
+    field = RULE_VALUES.get(row.sensors_settings)
+    if field is None or row.starts_at is None or row.stops_at is None:
+        return {**result, "reason": "Section has no sensor settings"}
+    value = getattr(row, field)
+    if value is None:
+        return {**result, "reason": "There is no sensor data for section"}
+    desired, reason = decide(value=value, starts_at=row.starts_at, stops_at=row.stops_at, status=row.status)
+    return {**result, "moisture": value, "desired": desired, "reason": reason}
+
+def evaluate_sections(rows: list):
+    results = []
+    for row in rows:
+        key = str(row.section_id)
+        stamp = section_stamp(row)
+        cached = section_results.get(key)
+        if cached is not None and cached[0] == stamp:
+            results.append(cached[1])
+            continue
+        result = evaluate_section(row)
+        section_results.set(key, (stamp, result), settings.evaluation_cache_ttl)
+        results.append(result)
+    return results
@@ -0,0 +1,83 @@
+from sqlalchemy import select
+from datetime import datetime
+from typing import Optional
+import csv
+import io
+import json
+
+import models
+import db
+
+EXPORT_CHUNK_SIZE = 1000
+
+SENSOR_DATA_COLUMNS = ["sensor_id", "date", "bat_level", "level_1", "level_2", "level_3",
+                       "temp_1", "temp_2", "temp_3", "temperature", "moisture"]
+FLOW_DATA_COLUMNS = ["pump_id", "date", "flow_rate"]
+
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+def sensor_data_query(sensor_id: Optional[str] = None, system_id: Optional[int] = None,
+                      date_from: Optional[datetime] = None, date_to: Optional[datetime] = None):
+    query = select(*[getattr(models.SensorData, column) for column in SENSOR_DATA_COLUMNS])
+    if sensor_id is not None:
+        query = query.where(models.SensorData.sensor_id == sensor_id)
+    if system_id is not None:
+        query = query.join(models.Sensor, models.Sensor.sensor_id == models.SensorData.sensor_id).where(
+            models.Sensor.system_id == system_id)
+    if date_from:
+        query = query.where(models.SensorData.date >= date_from)
+    if date_to:
+        query = query.where(models.SensorData.date < date_to)
+    return query.order_by(models.SensorData.sensor_id, models.SensorData.date)
+
+def flow_data_query(pump_id: Optional[str] = None, system_id: Optional[int] = None,
+                    date_from: Optional[datetime] = None, date_to: Optional[datetime] = None):
+    query = select(*[getattr(models.FlowData, column) for column in FLOW_DATA_COLUMNS])
+    if pump_id is not None:
+        query = query.where(models.FlowData.pump_id == pump_id)
+    if system_id is not None:
+        query = query.join(models.Pump, models.Pump.pump_id == models.FlowData.pump_id).where(
+            models.Pump.system_id == system_id)
+    if date_from:
+        query = query.where(models.FlowData.date >= date_from)
+    if date_to:
+        query = query.where(models.FlowData.date < date_to)
+    return query.order_by(models.FlowData.pump_id, models.FlowData.date)
+
+def stream_partitions(query):
+    # The request session is closed before a streamed body is sent, so the
+    # export holds its own session for as long as the client keeps reading.
+    session = db.SessionLocal()
+    try:
+        result = session.execute(query.execution_options(yield_per=EXPORT_CHUNK_SIZE))
+        for partition in result.partitions():
+            yield partition
+    finally:
+        session.close()
+
+def to_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+def to_ndjson(columns: list, partitions):
+    for rows in partitions:
+        yield "".join(json.dumps({column: to_value(value) for column, value in zip(columns, row)}) + "\n"
+                      for row in rows)
+
+def to_csv(columns: list, partitions):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    yield buffer.getvalue()
+    for rows in partitions:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows([to_value(value) for value in row] for row in rows)
+        yield buffer.getvalue()
+
+def stream_export(columns: list, query, fmt: str):
+    partitions = stream_partitions(query)
+    if fmt == "csv":
+        return to_csv(columns=columns, partitions=partitions)
+    return to_ndjson(columns=columns, partitions=partitions)
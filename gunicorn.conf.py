@@ -0,0 +1,24 @@
+import os
+
+from config import settings
+
+# Production server: gunicorn main:app -c gunicorn.conf.py
+# SIGHUP reloads the workers gracefully
+bind = settings.web_bind
+# CPUs this process may run on, not every core of the host
+workers = settings.web_workers or len(os.sched_getaffinity(0))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Recycle workers after a number of requests, jitter keeps them from restarting together
+max_requests = settings.web_max_requests
+max_requests_jitter = settings.web_max_requests_jitter
+
+timeout = settings.web_timeout
+graceful_timeout = settings.web_graceful_timeout
+keepalive = settings.web_keepalive
+
+# The app is loaded in each worker, so engines and pools are never shared after fork
+preload_app = False
+
+accesslog = "-"
+errorlog = "-"
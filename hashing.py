@@ -0,0 +1,62 @@
+from concurrent.futures import ProcessPoolExecutor
+from fastapi import HTTPException, status
+import asyncio
+import multiprocessing
+
+from config import settings
+import config
+
+# bcrypt runs in its own processes so a burst of logins can't starve the
+# event loop or the threadpool serving the device API.
+executor = None
+semaphore = None
+stats = {"queued": 0, "running": 0, "completed": 0, "rejected": 0}
+
+def get_executor():
+    global executor
+    if executor is None:
+        executor = ProcessPoolExecutor(max_workers=settings.hash_workers,
+                                       mp_context=multiprocessing.get_context("spawn"))
+    return executor
+
+def get_semaphore():
+    global semaphore
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(settings.hash_workers)
+    return semaphore
+
+async def run_in_pool(func, *args):
+    if stats["queued"] >= settings.hash_queue_size:
+        stats["rejected"] += 1
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many password requests. Please try again later",
+            headers={"Retry-After": "1"},
+        )
+    stats["queued"] += 1
+    try:
+        await get_semaphore().acquire()
+    finally:
+        stats["queued"] -= 1
+    stats["running"] += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(get_executor(), func, *args)
+    finally:
+        stats["running"] -= 1
+        stats["completed"] += 1
+        get_semaphore().release()
+
+async def verify_password(plain_password: str, hashed_password: str):
+    return await run_in_pool(config.verify_password, plain_password, hashed_password)
+
+async def get_hashed_password(password: str):
+    return await run_in_pool(config.get_hashed_password, password)
+
+def pool_status():
+    return {"workers": settings.hash_workers, "queue_size": settings.hash_queue_size, **stats}
+
+def shutdown():
+    global executor
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+        executor = None
@@ -0,0 +1,94 @@
+from sqlalchemy import insert
+from sqlalchemy.exc import DataError, IntegrityError
+from collections import deque
+from datetime import datetime
+import asyncio
+
+from config import settings
+import models
+import db
+
+# Device logs are accepted into memory and written by a background task in
+# bulk inserts. The buffer is bounded, add() returns False when it is full
+# so the route can push back on the device.
+entries = deque()
+flush_event = None
+flusher = None
+stats = {"accepted": 0, "rejected": 0, "written": 0, "dropped": 0, "failed_flushes": 0}
+
+def add(entry: dict):
+    if len(entries) >= settings.log_buffer_size:
+        stats["rejected"] += 1
+        return False
+    entry.setdefault("date", datetime.now().astimezone())
+    entries.append(entry)
+    stats["accepted"] += 1
+    if len(entries) >= settings.log_batch_size and flush_event:
+        flush_event.set()
+    return True
+
+async def write(batch: list):
+    async with db.AsyncSessionLocal() as session:
+        await session.execute(insert(models.Logs), batch)
+        await session.commit()
+
+# A rejected batch is retried row by row and the rows that still fail are
+# dropped, so one bad row can't block the logs behind it. Written rows are
+# removed from the batch, a connection error re-queues only the rest.
+async def write_rows(batch: list):
+    while batch:
+        try:
+            await write(batch[:1])
+            stats["written"] += 1
+        except (DataError, IntegrityError):
+            stats["dropped"] += 1
+        del batch[0]
+
+async def flush():
+    while entries:
+        batch = [entries.popleft() for _ in range(min(len(entries), settings.log_batch_size))]
+        try:
+            try:
+                await write(batch)
+                stats["written"] += len(batch)
+            except (DataError, IntegrityError):
+                await write_rows(batch)
+        except asyncio.CancelledError:
+            entries.extendleft(reversed(batch))
+            raise
+        except Exception:
+            # Connection problems keep the batch for the next flush, order is preserved
+            entries.extendleft(reversed(batch))
+            stats["failed_flushes"] += 1
+            return False
+    return True
+
+async def run():
+    while True:
+        try:
+            await asyncio.wait_for(flush_event.wait(), timeout=settings.log_flush_interval)
+        except asyncio.TimeoutError:
+            pass
+        flush_event.clear()
+        if not await flush():
+            await asyncio.sleep(settings.log_flush_interval)
+
+def start():
+    global flush_event, flusher
+    if flusher is None:
+        flush_event = asyncio.Event()
+        flusher = asyncio.create_task(run())
+
+async def stop():
+    global flusher
+    if flusher is not None:
+        flusher.cancel()
+        try:
+            await flusher
+        except asyncio.CancelledError:
+            pass
+        flusher = None
+        await flush()
+
+def buffer_status():
+    return {"buffered": len(entries), "buffer_size": settings.log_buffer_size, **stats}
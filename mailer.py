@@ -0,0 +1,155 @@
+from sqlalchemy import select, delete, or_
+from sqlalchemy.orm import Session
+from datetime import datetime, timedelta
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from threading import Event, Thread
+import logging
+import smtplib
+import time
+
+from config import settings
+import models
+import db
+
+# Mails are written to the mail_outbox table and sent by a background
+# dispatcher, so requests never wait on SMTP. Several workers can run a
+# dispatcher at once, rows are claimed with SKIP LOCKED. Mails hold secret
+# keys in plain text, so rows are deleted once sent or given up on.
+MAIL_BATCH_SIZE = 20
+
+logger = logging.getLogger(__name__)
+
+class SMTPConnection:
+    def __init__(self):
+        self.server = None
+        self.last_used = 0.0
+
+    def connect(self):
+        self.server = smtplib.SMTP(settings.smtp_server, settings.smtp_port, timeout=settings.smtp_timeout)
+        if settings.smtp_starttls:
+            self.server.starttls()
+        if settings.password:
+            self.server.login(settings.email, settings.password)
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.server = None
+
+    def close_if_idle(self):
+        if self.server is not None and time.monotonic() - self.last_used > settings.smtp_idle_timeout:
+            self.close()
+
+    def send(self, receiver: str, message: str):
+        if self.server is None:
+            self.connect()
+        try:
+            self.server.sendmail(settings.email, receiver, message)
+        except smtplib.SMTPServerDisconnected:
+            # The server dropped the idle connection, reconnect once
+            self.connect()
+            self.server.sendmail(settings.email, receiver, message)
+        self.last_used = time.monotonic()
+
+connection = SMTPConnection()
+wakeup = Event()
+stopping = Event()
+dispatcher = None
+
+def build_message(receiver: str, subject: str, text: str):
+    msg = MIMEMultipart("alternative")
+    msg["Subject"] = subject
+    msg["From"] = settings.email
+    msg["To"] = receiver
+    msg.attach(MIMEText(text, 'plain'))
+    return msg.as_string()
+
+def enqueue_mail(db: Session, receiver: str, subject: str, text: str):
+    db.add(models.MailOutbox(receiver=receiver, subject=subject, body=text))
+    db.commit()
+    wakeup.set()
+
+def enqueue_key_mail(db: Session, email: str, key: str):
+    text = f"Hello.\nYour secret key:\n {key}\nWith regards.\nAgritech Team"
+    enqueue_mail(db=db, receiver=email, subject="Request for secret key", text=text)
+
+def retry_delay(attempts: int):
+    return timedelta(seconds=min(settings.mail_retry_backoff * 2 ** (attempts - 1), settings.mail_retry_max_delay))
+
+# Removes rows left from before sent and failed mails were deleted
+def purge_finished():
+    session = db.SessionLocal()
+    try:
+        session.execute(delete(models.MailOutbox).where(or_(
+            models.MailOutbox.sent_at.is_not(None),
+            models.MailOutbox.attempts >= settings.mail_max_attempts)))
+        session.commit()
+    finally:
+        session.close()
+
+def dispatch_pending():
+    session = db.SessionLocal()
+    try:
+        mails = session.execute(
+            select(models.MailOutbox).where(
+                models.MailOutbox.sent_at.is_(None),
+                models.MailOutbox.attempts < settings.mail_max_attempts,
+                models.MailOutbox.next_attempt_at <= datetime.now().astimezone())
+            .order_by(models.MailOutbox.id).limit(MAIL_BATCH_SIZE)
+            .with_for_update(skip_locked=True)).scalars().all()
+        for mail in mails:
+            try:
+                connection.send(receiver=mail.receiver,
+                                message=build_message(mail.receiver, mail.subject, mail.body))
+                session.delete(mail)
+                logger.info("Email %s was sent", mail.id)
+            except (smtplib.SMTPException, OSError) as error:
+                connection.close()
+                mail.attempts += 1
+                if mail.attempts >= settings.mail_max_attempts:
+                    session.delete(mail)
+                    logger.error("Email %s failed for good after %s attempts: %s", mail.id, mail.attempts, error)
+                    continue
+                mail.last_error = str(error)
+                mail.next_attempt_at = datetime.now().astimezone() + retry_delay(mail.attempts)
+                logger.warning("Email %s failed, attempt %s: %s", mail.id, mail.attempts, error)
+        session.commit()
+        return len(mails)
+    finally:
+        session.close()
+
+def run():
+    try:
+        purge_finished()
+    except Exception:
+        logger.exception("Could not purge finished mails")
+    while not stopping.is_set():
+        try:
+            sent = dispatch_pending()
+        except Exception:
+            logger.exception("Mail dispatcher error")
+            sent = 0
+        if sent < MAIL_BATCH_SIZE:
+            connection.close_if_idle()
+            wakeup.wait(settings.mail_poll_interval)
+            wakeup.clear()
+    connection.close()
+
+def start():
+    global dispatcher
+    if dispatcher is None:
+        stopping.clear()
+        dispatcher = Thread(target=run, name="mail-dispatcher", daemon=True)
+        dispatcher.start()
+
+def stop():
+    global dispatcher
+    if dispatcher is not None:
+        stopping.set()
+        wakeup.set()
+        dispatcher.join(timeout=settings.smtp_timeout)
+        dispatcher = None
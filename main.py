@@ -1,22 +1,44 @@
 from fastapi import FastAPI
+from contextlib import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 
+from config import settings
 import models
-from db import engine
+import db
 from route import user_router, base_router, api_router
+import hashing
+import mailer
+import pubsub
+import logbuffer
 
-#models.Base.metadata.create_all(bind=engine)
+#models.Base.metadata.create_all(bind=db.engine)
 
 origins = ["*"]
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    db.init_engine()
+    mailer.start()
+    logbuffer.start()
+    if settings.pubsub_backend == "postgres":
+        pubsub.set_backend(pubsub.PostgresBackend(db.DATABASE_URL))
+    await pubsub.backend.start()
+    yield
+    await pubsub.backend.stop()
+    await logbuffer.stop()
+    mailer.stop()
+    hashing.shutdown()
+    await db.dispose_engine()
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag"],
 )
 
 app.include_router(user_router, tags=["users"])
@@ -1,4 +1,4 @@
-from sqlalchemy import Boolean, Column, Integer, String, Text, Time, ForeignKey, Float, DateTime
+from sqlalchemy import Boolean, Column, Integer, String, Text, Time, ForeignKey, Float, DateTime, Index
 from sqlalchemy.sql.sqltypes import TIMESTAMP
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
@@ -117,7 +117,8 @@ class Section(Base):
     id = Column(Integer, primary_key=True)
     shift_id = Column(Integer, ForeignKey(
         "shifts.id", ondelete="CASCADE"), nullable=False)
-    valve_id = Column(String(25), unique=True)
+    valve_id = Column(String(25), ForeignKey(
+        "valves.valve_id", ondelete="CASCADE"), unique=True)
     sensors_settings = Column(String(25))
     starts_at = Column(Float)
     stops_at = Column(Float)
@@ -175,6 +176,10 @@ class FlowData(Base):
     date = Column(TIMESTAMP(timezone=True), nullable=False,
                   server_default=text('now()'))
 
+    __table_args__ = (
+        Index("ix_flow_data_pump_id_date", pump_id, date.desc()),
+    )
+
 class SensorData(Base):
     __tablename__ = "sensor_data"
 
@@ -193,6 +198,36 @@ class SensorData(Base):
     date = Column(TIMESTAMP(timezone=True), nullable=False,
                   server_default=text('now()'))
 
+    __table_args__ = (
+        Index("ix_sensor_data_sensor_id_date", sensor_id, date.desc()),
+    )
+
+class LastFlowData(Base):
+    __tablename__ = "last_flow_data"
+
+    pump_id = Column(String(25), ForeignKey(
+        "pumps.pump_id", ondelete="CASCADE"), primary_key=True)
+    flow_rate = Column(Float)
+    date = Column(TIMESTAMP(timezone=True), nullable=False,
+                  server_default=text('now()'))
+
+class LastSensorData(Base):
+    __tablename__ = "last_sensor_data"
+
+    sensor_id = Column(String(25), ForeignKey(
+        "sensors.sensor_id", ondelete="CASCADE"), primary_key=True)
+    level_1 = Column(Float)
+    level_2 = Column(Float)
+    level_3 = Column(Float)
+    temp_1 = Column(Float)
+    temp_2 = Column(Float)
+    temp_3 = Column(Float)
+    temperature = Column(Float)
+    moisture = Column(Float)
+    bat_level = Column(Float)
+    date = Column(TIMESTAMP(timezone=True), nullable=False,
+                  server_default=text('now()'))
+
 class Logs(Base):
     __tablename__ = "logs"
 
@@ -203,6 +238,30 @@ class Logs(Base):
     date = Column(TIMESTAMP(timezone=True), nullable=False,
                   server_default=text('now()'))
 
+    __table_args__ = (
+        Index("ix_logs_dev_id_date", dev_id, date),
+    )
+
+class MailOutbox(Base):
+    __tablename__ = "mail_outbox"
+
+    id = Column(Integer, primary_key=True)
+    receiver = Column(String(50), nullable=False)
+    subject = Column(String(250), nullable=False)
+    body = Column(Text, nullable=False)
+    attempts = Column(Integer, nullable=False, server_default=text('0'))
+    last_error = Column(Text)
+    next_attempt_at = Column(TIMESTAMP(timezone=True), nullable=False,
+                             server_default=text('now()'))
+    sent_at = Column(TIMESTAMP(timezone=True))
+    created_at = Column(TIMESTAMP(timezone=True), nullable=False,
+                        server_default=text('now()'))
+
+    __table_args__ = (
+        Index("ix_mail_outbox_pending", next_attempt_at,
+              postgresql_where=sent_at.is_(None)),
+    )
+
 class Notification(Base):
     __tablename__ = "notifications"
 
@@ -0,0 +1,266 @@
+from collections import deque
+from threading import Lock, get_ident
+from typing import Any, List, Optional
+import asyncio
+import json
+import logging
+import time
+import uuid
+
+import asyncpg
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+class Subscription:
+    def __init__(self, topic: str, queue_size: int):
+        self.topic = topic
+        self.loop = asyncio.get_running_loop()
+        self.thread = get_ident()
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.overflowed = False
+        self.closed = False
+
+    def deliver(self, event: dict):
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Slow consumers are dropped and resume from the ring buffer
+            self.overflowed = True
+
+    def push(self, event: dict):
+        if get_ident() == self.thread:
+            self.deliver(event)
+        else:
+            try:
+                self.loop.call_soon_threadsafe(self.deliver, event)
+            except RuntimeError:
+                pass
+
+    # Wakes up a pending get() when the client goes away
+    def close(self):
+        self.closed = True
+        try:
+            self.queue.put_nowait(None)
+        except asyncio.QueueFull:
+            pass
+
+    async def get(self):
+        if self.overflowed or self.closed:
+            return None
+        return await self.queue.get()
+
+class Topic:
+    def __init__(self, buffer_size: int):
+        self.seq = 0
+        self.buffer = deque(maxlen=buffer_size)
+        self.subscribers = set()
+
+# Each hub start gets a new epoch so clients can tell that sequence
+# numbers from before a restart are no longer valid
+class Hub:
+    def __init__(self, buffer_size: int, queue_size: int):
+        self.epoch = uuid.uuid4().hex[:12]
+        self.buffer_size = buffer_size
+        self.queue_size = queue_size
+        self.topics = {}
+        self.lock = Lock()
+
+    def topic(self, name: str):
+        topic = self.topics.get(name)
+        if topic is None:
+            topic = self.topics[name] = Topic(self.buffer_size)
+        return topic
+
+    # Safe to call from the event loop and from threadpool routes
+    def publish(self, name: str, message: Any):
+        with self.lock:
+            topic = self.topic(name)
+            topic.seq += 1
+            event = {"seq": topic.seq, **message}
+            topic.buffer.append(event)
+            subscribers = list(topic.subscribers)
+        for subscription in subscribers:
+            subscription.push(event)
+        return event
+
+    # Returns the subscription, the current sequence number and the
+    # buffered events after `since`, or None when they can not be replayed
+    def subscribe(self, name: str, epoch: Optional[str] = None, since: Optional[int] = None):
+        subscription = Subscription(name, self.queue_size)
+        with self.lock:
+            topic = self.topic(name)
+            topic.subscribers.add(subscription)
+            seq = topic.seq
+            backlog = None
+            if epoch == self.epoch and since is not None and since <= seq:
+                if since == seq:
+                    backlog = []
+                elif topic.buffer and topic.buffer[0]["seq"] <= since + 1:
+                    backlog = [event for event in topic.buffer if event["seq"] > since]
+        return subscription, seq, backlog
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.lock:
+            topic = self.topics.get(subscription.topic)
+            if topic is None:
+                return
+            topic.subscribers.discard(subscription)
+            if not topic.subscribers and not topic.buffer:
+                del self.topics[subscription.topic]
+
+    def status(self):
+        with self.lock:
+            return {
+                "epoch": self.epoch,
+                "topics": len(self.topics),
+                "subscribers": sum(len(topic.subscribers) for topic in self.topics.values())
+            }
+
+hub = Hub(buffer_size=settings.pubsub_buffer_size, queue_size=settings.pubsub_queue_size)
+
+# Shared backends carry messages between workers, hand every received
+# message to hub.publish() and are installed with set_backend(). Messages
+# must stay JSON serializable for that.
+class PubSubBackend:
+    def publish(self, topic: str, message: dict):
+        raise NotImplementedError
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+class LocalBackend(PubSubBackend):
+    def publish(self, topic: str, message: dict):
+        hub.publish(topic, message)
+
+# Postgres LISTEN/NOTIFY between the workers. Every worker, the publisher
+# included, hands the received messages to its hub, so all of them see the
+# same order. Payloads over the NOTIFY limit go out in fragments within one
+# transaction and are joined again on receipt.
+NOTIFY_CHANNEL = "pubsub"
+NOTIFY_CHUNK_SIZE = 7000
+
+class PostgresBackend(PubSubBackend):
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self.loop = None
+        self.thread = None
+        self.outbox = None
+        self.task = None
+        self.connection = None
+        self.fragments = {}
+
+    def publish(self, topic: str, message: dict):
+        if self.loop is None:
+            hub.publish(topic, message)
+            return
+        payload = json.dumps({"topic": topic, "message": message})
+        if get_ident() == self.thread:
+            self.outbox.put_nowait(payload)
+        else:
+            try:
+                self.loop.call_soon_threadsafe(self.outbox.put_nowait, payload)
+            except RuntimeError:
+                pass
+
+    def receive(self, connection, pid: int, channel: str, payload: str):
+        id, index, total, chunk = payload.split(":", 3)
+        if total != "1":
+            parts = self.fragments.setdefault(id, [])
+            parts.append(chunk)
+            if len(parts) < int(total):
+                return
+            chunk = "".join(self.fragments.pop(id))
+        data = json.loads(chunk)
+        hub.publish(data["topic"], data["message"])
+
+    async def send(self, payload: str):
+        id = uuid.uuid4().hex[:12]
+        chunks = [payload[i:i + NOTIFY_CHUNK_SIZE] for i in range(0, len(payload), NOTIFY_CHUNK_SIZE)]
+        async with self.connection.transaction():
+            for index, chunk in enumerate(chunks):
+                await self.connection.execute("SELECT pg_notify($1, $2)", NOTIFY_CHANNEL,
+                                              f"{id}:{index}:{len(chunks)}:{chunk}")
+
+    async def close(self):
+        if self.connection is not None:
+            self.connection.terminate()
+            self.connection = None
+        self.fragments.clear()
+
+    async def run(self):
+        payload = None
+        while True:
+            try:
+                self.connection = await asyncpg.connect(self.dsn)
+                await self.connection.add_listener(NOTIFY_CHANNEL, self.receive)
+                while True:
+                    if payload is None:
+                        try:
+                            payload = await asyncio.wait_for(self.outbox.get(),
+                                                             timeout=settings.pubsub_keepalive)
+                        except asyncio.TimeoutError:
+                            # Idle listeners would not notice a dropped connection
+                            await self.connection.execute("SELECT 1")
+                            continue
+                    await self.send(payload)
+                    payload = None
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Messages wait in the outbox and go out after the reconnect
+                logger.exception("Pub/sub connection lost, reconnecting")
+                await self.close()
+                await asyncio.sleep(settings.pubsub_reconnect_delay)
+
+    async def start(self):
+        if self.task is None:
+            self.loop = asyncio.get_running_loop()
+            self.thread = get_ident()
+            self.outbox = asyncio.Queue()
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+            self.loop = None
+            await self.close()
+
+backend: PubSubBackend = LocalBackend()
+
+def set_backend(new_backend: PubSubBackend):
+    global backend
+    backend = new_backend
+
+def publish(topic: str, message: dict):
+    backend.publish(topic, message)
+
+def valve_topic(system_id: int):
+    return f"valves:{system_id}"
+
+def data_topic(system_id: int):
+    return f"data:{system_id}"
+
+def publish_valve(system_id: int, valve_id: str, status: Optional[bool]):
+    publish(valve_topic(system_id), {"type": "valve", "valve_id": valve_id, "status": status})
+
+# One event per system and batch, a large batch must not overflow the
+# subscriber queues or push older events out of the ring buffer
+def publish_data(systems: dict, kind: str, key: str, rows: List[dict]):
+    records = {}
+    for row in rows:
+        records.setdefault(systems[row[key]], []).append(row)
+    date = time.time()
+    for system_id, system_records in records.items():
+        publish(data_topic(system_id), {"type": kind, "date": date, "records": system_records})
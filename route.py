@@ -1,15 +1,24 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect, status
+from typing import List, Optional
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi.responses import JSONResponse, RedirectResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime
+import asyncio
 
 import schema
 import db
 import crud
 import config
+import export
+import hashing
+import mailer
+import schedule
+import pubsub
+import logbuffer
+import evaluation
 
 base_router = APIRouter()
 user_router = APIRouter()
@@ -112,17 +121,7 @@ def create_new_sensor(sensor: schema.AddSensor, db: Session = Depends(db.get_db)
 # Create shifts
 @base_router.post("/shift", response_model=schema.ShiftsWithID)
 def create_new_shift(shift: schema.AddShift, db: Session = Depends(db.get_db), current_user: str = Depends(crud.get_current_user)):
-    system = crud.get_system(db=db, system_id=shift.system_id)
-    if not system:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Could not found system in database"
-        )
-    if current_user.username != system.owner:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not authorized to update database"
-        )
+    crud.authorize(db=db, current_user=current_user, resource="system", id=shift.system_id)
     try:
         new_shift = crud.create_shift(db=db, shift=shift)
         return new_shift
@@ -135,28 +134,11 @@ def create_new_shift(shift: schema.AddShift, db: Session = Depends(db.get_db), c
 # Create shift's section
 @base_router.post("/section", response_model=schema.SectionWithID)
 def create_new_shift_section(section: schema.SectionCreate, db: Session = Depends(db.get_db), current_user: str = Depends(crud.get_current_user)):
-    shift = crud.get_shift(db=db, shift_id=section.shift_id)
-    if not shift:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Could not found shift in database"
-        )
-    system = crud.get_system(db=db, system_id=shift.system_id)
-    if not system:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Could not found system in database"
-        )
-    if current_user.username != system.owner:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not authorized to update database"
-        )
-    available_valves = crud.check_for_valve_in_sections(
-        db=db, shift_id=section.shift_id)
+    owner = crud.authorize(db=db, current_user=current_user, resource="shift", id=section.shift_id)
     try:
-        if section.valve_id in available_valves:
+        if crud.is_valve_available(db=db, shift_id=section.shift_id, valve_id=section.valve_id):
             new_section = crud.create_section(db=db, section=section)
+            schedule.invalidate(owner.system_id)
             return new_section
         else:
             return {"detail": "Selected valve is not available. Please try another one."}
@@ -166,31 +148,26 @@ def create_new_shift_section(section: schema.SectionCreate, db: Session = Depend
             detail="Something went wrong with connection to database"
         )
 
+# Valves that can still be assigned to a shift section
+@base_router.get("/available_valves/{shift_id}", response_model=List[str])
+def available_valves(shift_id: int, db: Session = Depends(db.get_db),
+                     owner = Depends(crud.owned("shift", "shift_id", allow_admin=True))):
+    try:
+        return crud.get_available_valves(db=db, shift_id=shift_id)
+    except:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Something went wrong with connection to database"
+        )
+
 # Create sensor controler
 @base_router.post("/sensorControler", response_model=schema.SControlWithID)
 def create_new_sensor_controler(controler: schema.SensorControler, db: Session = Depends(db.get_db), current_user: str = Depends(crud.get_current_user)):
+    owner = crud.authorize(db=db, current_user=current_user, resource="section", id=controler.section_id)
     sensor_contolers = crud.get_sensor_controlers(
         db=db, section_id=controler.section_id)
-    section = crud.get_section(db=db, id=controler.section_id)
-    if not section:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Could not found section in database"
-        )
-    shift = crud.get_shift(db=db, shift_id=section.shift_id)
-    system = crud.get_system(db=db, system_id=shift.system_id)
-    if not system:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Could not found system in database"
-        )
-    if current_user.username != system.owner:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not authorized to update database"
-        )
     available_sensors = []
-    for sensor in system.system_sensors:
+    for sensor in crud.get_system_sensors(db=db, system_id=owner.system_id):
         available_sensors.append(sensor.sensor_id)
     sensors = []
     for new_sensor in sensor_contolers:
@@ -203,6 +180,7 @@ def create_new_sensor_controler(controler: schema.SensorControler, db: Session =
         else:
             new_controler = crud.add_new_sensor_controler(
                 db=db, scontroler=controler)
+            schedule.invalidate(owner.system_id)
             return new_controler
     except:
         raise HTTPException(
@@ -213,47 +191,21 @@ def create_new_sensor_controler(controler: schema.SensorControler, db: Session =
 # Create timer controler
 @base_router.post("/timer", response_model=schema.TControlWithID)
 def create_new_timer(controler: schema.TimerControl, db: Session = Depends(db.get_db), current_user: str = Depends(crud.get_current_user)):
-    check_timers = []
-    timers = []
-    shift = crud.get_shift(db=db, shift_id=controler.shift_id)
-    if not shift:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Could not found shift in database"
-        )
-    system = crud.get_system(db=db, system_id=shift.system_id)
-    if not system:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Could not found system in database"
-        )
-    if current_user.username != system.owner:
+    owner = crud.authorize(db=db, current_user=current_user, resource="shift", id=controler.shift_id)
+    if controler.starts is not None and controler.stops is not None and controler.starts >= controler.stops:
+        return {"detail": "Start values must be less than stop value."}
+    try:
+        timers = schedule.WeeklyIntervalIndex(crud.get_system_timers(db=db, system_id=owner.system_id))
+        if timers.overlaps(controler):
+            return {"detail": "Timers match each other."}
+        new_timer = crud.add_new_timer(db=db, tcontroler=controler)
+        schedule.invalidate(owner.system_id)
+        return new_timer
+    except:
         raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not authorized to update database"
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Something went wrong with connection to database"
         )
-    system_shifts = []
-    for entry in system.system_shifts:
-        system_shifts.append(entry)
-    for data in system_shifts:
-        for timer in data.shift_timers:
-            timers.append(timer)
-    for timer in timers:
-        timer_to_dict = timer.serialize()
-        check_timers.append(timer_to_dict)
-    else:
-        try:
-            for timer in check_timers:
-                print("Checking available timers....")
-                if crud.do_timers_interfere(timer1=timer, timer2=controler.serialize()):
-                    return {"detail": "Timers match each other."}
-            new_timer = crud.add_new_timer(db=db, tcontroler=controler)
-            return new_timer
-        except:
-            raise HTTPException(
-                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                detail="Something went wrong with connection to database"
-            )
 
 
 """ UPDATEROUTES """
@@ -283,26 +235,26 @@ def user_self_update(username: str, user: schema.UserUpdate, db: Session = Depen
 
 # Change password by user
 @base_router.patch("/change_password/{username}")
-def user_change_password(username: str, password: schema.LostPassword, db: Session = Depends(db.get_db), current_user: str = Depends(crud.get_current_user)):
+async def user_change_password(username: str, password: schema.LostPassword, db: AsyncSession = Depends(db.get_async_db), current_user: str = Depends(crud.get_current_user)):
     if current_user.username != username:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You are not authorized to update database"
         )
-    user_to_update = crud.get_user(db=db, username=username)
-    if not user_to_update:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Could not found user in database"
-        )
+    hashed_password = await hashing.get_hashed_password(password.password)
     try:
-        crud.change_password(db=db, username=username, password=password)
-        return {"detail": "Successfully changed password"}
+        updated = await crud.async_change_password(db=db, username=username, hashed_password=hashed_password)
     except:
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             detail="Something went wrong with connection to database"
         )
+    if not updated:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Could not found user in database"
+        )
+    return {"detail": "Successfully changed password"}
 
 # Update user by admin
 @base_router.put("/admin/{username}")
@@ -330,19 +282,7 @@ def user_admin_update(username: str, user: schema.AdminUserUpdate, db: Session =
 # Update system
 @base_router.put("/system/{system_id}")
 def system_update(system_id: int, to_update: schema.SystemUpdate, db: Session = Depends(db.get_db),
-                  current_user: str = Depends(crud.get_current_user)):
-
-    system_to_update = crud.get_system(db=db, system_id=system_id)
-    if not system_to_update:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Could not found system in database"
-        )
-    if current_user.username != system_to_update.owner:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not authorized to update database"
-        )
+                  owner = Depends(crud.owned("system", "system_id"))):
     try:
         crud.update_system(db=db, system=to_update, system_id=system_id)
         return {"detail": "Successfully updated database"}
@@ -355,20 +295,7 @@ def system_update(system_id: int, to_update: schema.SystemUpdate, db: Session =
 # Update pump
 @base_router.put("/pump/{pump_id}")
 def pump_update(pump_id: str, pump_to_update: schema.UpdatePump, db: Session = Depends(db.get_db),
-                current_user: str = Depends(crud.get_current_user)):
-
-    existing_pump = crud.get_pump(db=db, pump_id=pump_id)
-    if not existing_pump:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Could not found pump in database"
-        )
-    system = crud.get_system(db=db, system_id=existing_pump.system_id)
-    if current_user.username != system.owner:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not authorized to update database"
-        )
+                owner = Depends(crud.owned("pump", "pump_id"))):
     try:
         crud.update_pump(db=db, pump=pump_to_update, pump_id=pump_id)
         return {"detail": "Successfully updated database"}
@@ -381,20 +308,7 @@ def pump_update(pump_id: str, pump_to_update: schema.UpdatePump, db: Session = D
 # Update valve
 @base_router.put("/valve/{valve_id}")
 def valve_update(valve_id: str, valve_to_update: schema.UpdateValve, db: Session = Depends(db.get_db),
-                 current_user: str = Depends(crud.get_current_user)):
-
-    existing_valve = crud.get_valve(db=db, valve_id=valve_id)
-    if not existing_valve:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Could not found valve in database"
-        )
-    system = crud.get_system(db=db, system_id=existing_valve.system_id)
-    if current_user.username != system.owner:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not authorized to update database"
-        )
+                 owner = Depends(crud.owned("valve", "valve_id"))):
     try:
         crud.update_valve(db=db, valve=valve_to_update, valve_id=valve_id)
         return {"detail": "Successfully updated database"}
@@ -407,20 +321,7 @@ def valve_update(valve_id: str, valve_to_update: schema.UpdateValve, db: Session
 # Update sensor
 @base_router.put("/sensor/{sensor_id}")
 def sensor_update(sensor_id: str, sensor_to_update: schema.UpdateSensor, db: Session = Depends(db.get_db),
-                  current_user: str = Depends(crud.get_current_user)):
-
-    existing_sensor = crud.get_sensor(db=db, sensor_id=sensor_id)
-    if not existing_sensor:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Could not found sensor in database"
-        )
-    system = crud.get_system(db=db, system_id=existing_sensor.system_id)
-    if current_user.username != system.owner:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not authorized to update database"
-        )
+                  owner = Depends(crud.owned("sensor", "sensor_id"))):
     try:
         crud.update_sensor(
             db=db, sensor=sensor_to_update, sensor_id=sensor_id)
@@ -434,20 +335,7 @@ def sensor_update(sensor_id: str, sensor_to_update: schema.UpdateSensor, db: Ses
 # Update section
 @base_router.put("/section/{id}")
 def section_update(id: int, section_to_update: schema.SectionUpdate, db: Session = Depends(db.get_db),
-                   current_user: str = Depends(crud.get_current_user)):
-    section = crud.get_section(db=db, id=id)
-    if not section:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Could not found shift in database"
-        )
-    shift = crud.get_shift(db=db, shift_id=section.shift_id)
-    system = crud.get_system(db=db, system_id=shift.system_id)
-    if current_user.username != system.owner:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not authorized to update database"
-        )
+                   owner = Depends(crud.owned("section", "id"))):
     sensor_option = ["AVG", "ONE", "ALL"]
     if section_to_update.stops_at <= section_to_update.starts_at or section_to_update.starts_at < 0 or section_to_update.stops_at > 100:
         return {"detail": "Start values must be less than 100, greater than 0 and start value must be lower than stop value."}
@@ -455,6 +343,7 @@ def section_update(id: int, section_to_update: schema.SectionUpdate, db: Session
         return {"detail": "Select one of options: AVG/ONE/ALL."}
     try:
         crud.change_section(db=db, section=section_to_update, id=id)
+        schedule.invalidate(owner.system_id)
         return {"detail": "Successfully updated database"}
     except:
         raise HTTPException(
@@ -465,40 +354,17 @@ def section_update(id: int, section_to_update: schema.SectionUpdate, db: Session
 # Update sensor controler
 @base_router.patch("/sensorControler/{controler_id}")
 def change_sensor_controler_settings(controler_id: int, controler_to_update: schema.SensorControler, db: Session = Depends(db.get_db), 
-                                     current_user: str = Depends(crud.get_current_user)):
+                                     owner = Depends(crud.owned("controler", "controler_id"))):
     controler = crud.get_sensor_controler(db=db, id=controler_id)
-    if not controler:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Could not found controler in database"
-        )
     sensor_contolers = crud.get_sensor_controlers(
         db=db, section_id=controler.section_id)
-    section = crud.get_section(db=db, id=controler.section_id)
-    if not section:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Could not found section in database"
-        )
-    shift = crud.get_shift(db=db, shift_id=section.shift_id)
-    system = crud.get_system(db=db, system_id=shift.system_id)
-    if not system:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Could not found system in database"
-        )
-    if current_user.username != system.owner:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not authorized to update database"
-        )
     available_sensors = []
-    for sensor in system.system_sensors:
+    for sensor in crud.get_system_sensors(db=db, system_id=owner.system_id):
         available_sensors.append(sensor.sensor_id)
     sensors = []
     for new_sensor in sensor_contolers:
         sensors.append(new_sensor.sensor_id)
-    if controler_to_update.section_id != section.id:
+    if controler_to_update.section_id != controler.section_id:
         return {"detail": "Can't update unproper section ID."}
     elif controler_to_update.sensor_id not in available_sensors:
         return {"detail": "There is no such sensor in system. Please check device ID."}
@@ -509,6 +375,7 @@ def change_sensor_controler_settings(controler_id: int, controler_to_update: sch
             else:
                 crud.change_sensor_controler(
                     db=db, scontroler=controler_to_update, id=controler_id)
+                schedule.invalidate(owner.system_id)
                 return {"detail": "Successfully updated database"}
         except:
             raise HTTPException(
@@ -519,52 +386,18 @@ def change_sensor_controler_settings(controler_id: int, controler_to_update: sch
 # Update timer shift controler
 @base_router.patch("/timer/{id}")
 def change_timer_controler_settings(id: int, controler_to_update: schema.TimerUpdate, db: Session = Depends(db.get_db), 
-                                    current_user: str = Depends(crud.get_current_user)):
-    controler = crud.get_timer(db=db, id=id)
-    if not controler:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Could not found controler in database"
-        )
-    check_timers = []
-    timers = []
-    shift = crud.get_shift(db=db, shift_id=controler.shift_id)
-    if not shift:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Could not found shift in database"
-        )
-    system = crud.get_system(db=db, system_id=shift.system_id)
-    if not system:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Could not found system in database"
-        )
-    if current_user.username != system.owner:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not authorized to update database"
-        )
-    system_shifts = []
-    for entry in system.system_shifts:
-        system_shifts.append(entry)
-    for data in system_shifts:
-        for timer in data.shift_timers:
-            if timer.id != id:
-                timers.append(timer)
-    for timer in timers:
-        timer_to_dict = timer.serialize()
-        check_timers.append(timer_to_dict)
+                                    owner = Depends(crud.owned("timer", "id"))):
     if controler_to_update.starts >= controler_to_update.stops:
         return {"detail": "Start values must be less than stop value."}
     else:
         try:
-            for timer in check_timers:
-                print("Checking available timers....")
-                if crud.do_timers_interfere(timer1=timer, timer2=controler_to_update.serialize()):
-                    return {"detail": "Timers match each other."}
+            timers = schedule.WeeklyIntervalIndex(
+                crud.get_system_timers(db=db, system_id=owner.system_id, exclude_id=id))
+            if timers.overlaps(controler_to_update):
+                return {"detail": "Timers match each other."}
             crud.change_timer_settings(
                 db=db, tcontroler=controler_to_update, id=id)
+            schedule.invalidate(owner.system_id)
             return {"detail": "Successfully updated database"}
         except:
             raise HTTPException(
@@ -630,8 +463,9 @@ def delete_system(system_id: int, db: Session = Depends(db.get_db), current_user
             detail="You are not authorized to update database"
         )
     try:
-        crud.delete_system(system_id=system_id, db=db)
-        return {"detail": "Successfully updated database"}
+        deleted = crud.delete_system(system_id=system_id, db=db)
+        schedule.invalidate(system_id)
+        return {"detail": "Successfully updated database", "deleted": deleted}
     except:
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
@@ -676,8 +510,9 @@ def delete_valve(valve_id: str, db: Session = Depends(db.get_db), current_user:
             detail="You are not authorized to update database"
         )
     try:
-        crud.delete_valve(valve_id=valve_id, db=db)
-        return {"detail": "Successfully updated database"}
+        deleted = crud.delete_valve(valve_id=valve_id, db=db)
+        schedule.invalidate(valve_to_delete.system_id)
+        return {"detail": "Successfully updated database", "deleted": deleted}
     except:
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
@@ -700,6 +535,7 @@ def delete_sensor(sensor_id: str, db: Session = Depends(db.get_db), current_user
         )
     try:
         crud.delete_sensor(sensor_id=sensor_id, db=db)
+        schedule.invalidate(sensor_to_delete.system_id)
         return {"detail": "Successfully updated database"}
     except:
         raise HTTPException(
@@ -709,22 +545,11 @@ def delete_sensor(sensor_id: str, db: Session = Depends(db.get_db), current_user
 
 # Delete shift route
 @base_router.delete("/shift/{shift_id}")
-def delete_shift(shift_id: int, db: Session = Depends(db.get_db), current_user: str = Depends(crud.get_current_user)):
-    shift_to_delete = crud.get_shift(db=db, shift_id=shift_id)
-    if not shift_to_delete:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Could not found shift in database"
-        )
-    system = crud.get_system(db=db, system_id=shift_to_delete.system_id)
-    if not current_user.admin and current_user.username != system.owner:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not authorized to update database"
-        )
+def delete_shift(shift_id: int, db: Session = Depends(db.get_db), owner = Depends(crud.owned("shift", "shift_id", allow_admin=True))):
     try:
-        crud.delete_shift(shift_id=shift_id, db=db)
-        return {"detail": "Successfully updated database"}
+        deleted = crud.delete_shift(shift_id=shift_id, db=db)
+        schedule.invalidate(owner.system_id)
+        return {"detail": "Successfully updated database", "deleted": deleted}
     except:
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
@@ -733,25 +558,11 @@ def delete_shift(shift_id: int, db: Session = Depends(db.get_db), current_user:
 
 # Delete Shift section route
 @base_router.delete("/section/{id}")
-def delete_shift_section(id: int, db: Session = Depends(db.get_db), current_user: str = Depends(crud.get_current_user)):
-    section_to_delete = crud.get_section(db=db, id=id)
-    if not section_to_delete:
-        return {"detail": f"There is no section with ID: {id}."}
-    shift = crud.get_shift(db=db, shift_id=section_to_delete.shift_id)
-    system = crud.get_system(db=db, system_id=shift.system_id)
-    if not section_to_delete:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Could not found shift in database"
-        )
-    if not current_user.admin and current_user.username != system.owner:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not authorized to update database"
-        )
+def delete_shift_section(id: int, db: Session = Depends(db.get_db), owner = Depends(crud.owned("section", "id", allow_admin=True))):
     try:
-        crud.delete_section(db=db, id=id)
-        return {"detail": "Successfully updated database"}
+        deleted = crud.delete_section(db=db, id=id)
+        schedule.invalidate(owner.system_id)
+        return {"detail": "Successfully updated database", "deleted": deleted}
     except:
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
@@ -760,23 +571,10 @@ def delete_shift_section(id: int, db: Session = Depends(db.get_db), current_user
 
 # Delete sensor controler route
 @base_router.delete("/sensorControler/{id}")
-def delete_sensor_controler(id: int, db: Session = Depends(db.get_db), current_user: str = Depends(crud.get_current_user)):
-    controler_to_delete = crud.get_sensor_controler(db=db, id=id)
-    if not controler_to_delete:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"There is no controler with ID: {id}."
-        )
-    section = crud.get_section(db=db, id=controler_to_delete.section_id)
-    shift = crud.get_shift(db=db, shift_id=section.shift_id)
-    system = crud.get_system(db=db, system_id=shift.system_id)
-    if not current_user.admin and current_user.username != system.owner:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not authorized to update database"
-        )
+def delete_sensor_controler(id: int, db: Session = Depends(db.get_db), owner = Depends(crud.owned("controler", "id", allow_admin=True))):
     try:
         crud.delete_sensor_controler(db=db, id=id)
+        schedule.invalidate(owner.system_id)
         return {"detail": "Successfully updated database"}
     except:
         raise HTTPException(
@@ -786,22 +584,10 @@ def delete_sensor_controler(id: int, db: Session = Depends(db.get_db), current_u
 
 # Delete timer route
 @base_router.delete("/timer/{id}")
-def delete_timer(id: int, db: Session = Depends(db.get_db), current_user: str = Depends(crud.get_current_user)):
-    timer_to_delete = crud.get_timer(db=db, id=id)
-    if not timer_to_delete:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"There is no timer with ID: {id}."
-        )
-    shift = crud.get_shift(db=db, shift_id=timer_to_delete.shift_id)
-    system = crud.get_system(db=db, system_id=shift.system_id)
-    if not current_user.admin and current_user.username != system.owner:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not authorized to update database"
-        )
+def delete_timer(id: int, db: Session = Depends(db.get_db), owner = Depends(crud.owned("timer", "id", allow_admin=True))):
     try:
         crud.delete_timer(db=db, id=id)
+        schedule.invalidate(owner.system_id)
         return {"detail": "Successfully updated database"}
     except:
         raise HTTPException(
@@ -830,27 +616,33 @@ def delete_log(log_id: int, db: Session = Depends(db.get_db)):
 """ User routers """
 #Create user
 @user_router.post("/register")
-def create_user(user: schema.UserCreate, db: Session = Depends(db.get_db)):
-    db_user = crud.get_user(db, username=user.username)
+async def create_user(user: schema.UserCreate, db: AsyncSession = Depends(db.get_async_db)):
+    db_user = await crud.async_get_user(db, username=user.username)
     if db_user:
         raise HTTPException(status_code = status.HTTP_401_UNAUTHORIZED, detail="Username already exists")
-    user_mail= crud.get_user_email(db, email=user.email)
+    user_mail= await crud.async_get_user_email(db, email=user.email)
     if user_mail:
         raise HTTPException(status_code = status.HTTP_401_UNAUTHORIZED, detail="Email already exists")
-    user = crud.create_user(user=user, db=db)
+    # Don't hold a connection while the hash waits for the process pool
+    await db.close()
+    hashed_password = await hashing.get_hashed_password(user.password)
+    user = await crud.async_create_user(user=user, db=db, hashed_password=hashed_password)
     return {"detail": "New user was created successfully"}
 
 #Change password
 @user_router.patch("/reset_password/{secret}")
-def user_reset_password(password: schema.ResetPassword, db: Session = Depends(db.get_db)):
-    password_to_update = crud.get_user_by_secret(db=db, secret=password.secret)
+async def user_reset_password(password: schema.ResetPassword, db: AsyncSession = Depends(db.get_async_db)):
+    password_to_update = await crud.async_get_user_by_secret(db=db, secret=password.secret)
     if not password_to_update:
         raise HTTPException(
             status_code = status.HTTP_404_NOT_FOUND,
             detail = "Could not found user in database"
         )
+    # Don't hold a connection while the hash waits for the process pool
+    await db.close()
+    hashed_password = await hashing.get_hashed_password(password.password)
     try:
-        crud.reset_password(db=db, password=password)
+        await crud.async_reset_password(db=db, secret=password.secret, hashed_password=hashed_password)
         return {"detail": "Successfully changed password"}
     except:
         raise HTTPException(
@@ -868,13 +660,13 @@ def get_secret_key(username: str, db: Session = Depends(db.get_db)):
             detail="Couldn't find user",
         )
     else:
-        config.send_key_to_mail(email=user.email, key=user.secret)
+        mailer.enqueue_key_mail(db=db, email=user.email, key=user.secret)
         return RedirectResponse("/reset", status_code=status.HTTP_302_FOUND)
         
 #Login user
 @user_router.post("/login", response_model=schema.Token)
-def log_user(user: OAuth2PasswordRequestForm = Depends(), db: Session=Depends(db.get_db)):
-    db_user = crud.validate_user(db=db, user=user)
+async def log_user(user: OAuth2PasswordRequestForm = Depends(), db: AsyncSession=Depends(db.get_async_db)):
+    db_user = await crud.async_validate_user(db=db, user=user)
 
     if not db_user:
         raise HTTPException(
@@ -909,122 +701,285 @@ def read_users(skip: int = 0, limit: int = 50, db: Session = Depends(db.get_db))
 
 """ Devices API endpoints """
 
+def is_not_modified(request: Request, etag: str):
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+def not_modified_response(etag: str):
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED,
+                    headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+def set_etag(response: Response, etag: str):
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+
+def get_cursor(cursor: Optional[str]):
+    if not cursor:
+        return None
+    try:
+        return crud.decode_cursor(cursor)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor. Use value from X-Next-Cursor header"
+        )
+
 #Flow date routes
 @api_router.post("/flowdata")
-def flow_data(flow: schema.AddFlowData, db: Session = Depends(db.get_db)):
-    pump_flow = crud.get_pump(db=db, pump_id=flow.pump_id)
-    if not pump_flow:
+async def flow_data(flow: schema.AddFlowData, db: AsyncSession = Depends(db.get_async_db)):
+    try:
+        results = await crud.async_create_flow_data_batch(db=db, records=[flow])
+    except:
+        return {"detail": "Couldn't find pump in database"}
+    if not results[0].accepted:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="There is no such pump. Please check device ID"
         )
+    return {"detail": "Successfully updated pump volume"}
+
+@api_router.post("/flowdata/batch", response_model=schema.BatchResponse)
+async def flow_data_batch(records: List[schema.AddFlowData], db: AsyncSession = Depends(db.get_async_db)):
+    if len(records) > crud.MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Batch can't contain more than {crud.MAX_BATCH_SIZE} records"
+        )
     try:
-        db_flow = crud.create_flow_data(db=db, flow=flow)
-        new_volume = pump_flow.current - flow.flow_rate
-        crud.update_pump_data(
-            db=db, pump_id=db_flow.pump_id, current=new_volume) 
-        return {"detail": "Successfully updated pump volume"}
+        results = await crud.async_create_flow_data_batch(db=db, records=records)
     except:
-        return {"detail": "Couldn't find pump in database"}
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Something went wrong with connection to database"
+        )
+    accepted = sum(1 for result in results if result.accepted)
+    return {"accepted": accepted, "rejected": len(results) - accepted, "results": results}
 
 @api_router.get("/flowdata/{pump_id}", response_model=List[schema.GetFlowData])
-def all_flow_data(pump_id: str, db: Session = Depends(db.get_db)):
+def all_flow_data(pump_id: str, response: Response, date_from: Optional[datetime] = Query(None, alias="from"),
+                  date_to: Optional[datetime] = Query(None, alias="to"), cursor: Optional[str] = None,
+                  limit: int = Query(crud.HISTORY_PAGE_SIZE, ge=1, le=crud.MAX_HISTORY_PAGE_SIZE),
+                  db: Session = Depends(db.get_db)):
     pump = crud.get_pump(db=db, pump_id=pump_id)
     if not pump:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="There is no such pump. Please check device ID"
         )
+    after = get_cursor(cursor)
     try:
-        db_data = crud.get_all_flow_data(db=db, pump_id=pump_id)
-        if not db_data:
-            return {"detail": "There is no available data"}
-        return db_data.all()
+        db_data, next_cursor = crud.get_flow_data_page(
+            db=db, pump_id=pump_id, date_from=date_from, date_to=date_to, after=after, limit=limit)
     except:
         return {"detail": "There is problems with database"}
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return db_data
 
 @api_router.get("/lastflowdata/{pump_id}", response_model=schema.GetFlowData)
 def last_flow_data(pump_id: str, db: Session = Depends(db.get_db)):
+    try:
+        last_data = crud.get_last_flow_data(db=db, pump_id=pump_id)
+    except:
+        return {"detail": "There is problems with database"}
+    if last_data:
+        return last_data
     pump = crud.get_pump(db=db, pump_id=pump_id)
     if not pump:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="There is no such pump. Please check device ID"
         )
-    try:
-        last_data = crud.get_flow_data(db=db, pump_id=pump_id)
-        if not last_data:
-            return {"detail": "There is no available data"}
-        return last_data
-    except:
-        return {"detail": "There is problems with database"}
+    return {"detail": "There is no available data"}
 
 #Sensor data routes
 @api_router.post("/sensordata")
-def sensor_data(sensor_data: schema.AddSensorData, db: Session = Depends(db.get_db)):
+async def sensor_data(sensor_data: schema.AddSensorData, db: AsyncSession = Depends(db.get_async_db)):
     try:
-        new_data = crud.create_sensor_data(db=db, sensor=sensor_data)
-        sensor = crud.get_sensor(db=db, sensor_id=new_data.sensor_id)
-        moisture = {"level_1": new_data.level_1,
-                "level_2": new_data.level_2, "level_3": new_data.level_3}
-        temp = {"level_1": new_data.temp_1,
-                "level_2": new_data.temp_2, "level_3": new_data.temp_3}
-        settings = {"level_1": sensor.set_lvl_1,
-                    "level_2": sensor.set_lvl_2, "level_3": sensor.set_lvl_3}
-        user_setup = [f"level_{i}" for i in range(1, 4) if settings[f"level_{i}"]]
-        y = len(user_setup)
-        new_readings = 0
-        for i in user_setup:
-            new_readings += moisture[i]/y
-        new_temp = 0
-        for j in user_setup:
-            new_temp += temp[j]/y
-        crud.update_sensor_data(
-            db=db, sensor_id=new_data.sensor_id, readings=new_readings, temp= new_temp)
-        return {"detail": "Successfully updated sensor readings"}
+        results = await crud.async_create_sensor_data_batch(db=db, records=[sensor_data])
     except:
         return {"detail": "Couldn't find sensor in database"}
+    if not results[0].accepted:
+        return {"detail": "Couldn't find sensor in database"}
+    return {"detail": "Successfully updated sensor readings"}
+
+@api_router.post("/sensordata/batch", response_model=schema.BatchResponse)
+async def sensor_data_batch(records: List[schema.AddSensorData], db: AsyncSession = Depends(db.get_async_db)):
+    if len(records) > crud.MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Batch can't contain more than {crud.MAX_BATCH_SIZE} records"
+        )
+    try:
+        results = await crud.async_create_sensor_data_batch(db=db, records=records)
+    except:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Something went wrong with connection to database"
+        )
+    accepted = sum(1 for result in results if result.accepted)
+    return {"accepted": accepted, "rejected": len(results) - accepted, "results": results}
 
 @api_router.get("/sensordata/{sensor_id}", response_model=List[schema.SensorData])
-def all_sensor_data(sensor_id: str, db: Session = Depends(db.get_db)):
+def all_sensor_data(sensor_id: str, response: Response, date_from: Optional[datetime] = Query(None, alias="from"),
+                    date_to: Optional[datetime] = Query(None, alias="to"), cursor: Optional[str] = None,
+                    limit: int = Query(crud.HISTORY_PAGE_SIZE, ge=1, le=crud.MAX_HISTORY_PAGE_SIZE),
+                    db: Session = Depends(db.get_db)):
+    sensor = crud.get_sensor(db=db, sensor_id=sensor_id)
+    if not sensor:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="There is no such sensor. Please check device ID"
+        )
+    after = get_cursor(cursor)
+    try:
+        db_data, next_cursor = crud.get_sensor_data_page(
+            db=db, sensor_id=sensor_id, date_from=date_from, date_to=date_to, after=after, limit=limit)
+    except:
+        return {"detail": "There is problems with database"}
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return db_data
+
+@api_router.get("/sensordata/{sensor_id}/aggregate", response_model=List[schema.SensorDataBucket])
+def aggregate_sensor_data(sensor_id: str, response: Response, bucket: str = Query("hour", pattern="^(minute|hour|day)$"),
+                          date_from: Optional[datetime] = Query(None, alias="from"),
+                          date_to: Optional[datetime] = Query(None, alias="to"), cursor: Optional[str] = None,
+                          limit: int = Query(crud.MAX_AGGREGATE_BUCKETS, ge=1, le=crud.MAX_AGGREGATE_BUCKETS),
+                          db: Session = Depends(db.get_db)):
     sensor = crud.get_sensor(db=db, sensor_id=sensor_id)
     if not sensor:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="There is no such sensor. Please check device ID"
         )
+    after = get_cursor(cursor)
     try:
-        db_data = crud.get_all_sensor_data(db=db, sensor_id=sensor_id)
-        if not db_data:
-            return {"detail": "There is no available data"}
-        return db_data.all()
+        aggregates, next_cursor = crud.get_sensor_data_aggregates(
+            db=db, sensor_id=sensor_id, bucket=bucket, date_from=date_from, date_to=date_to, after=after, limit=limit)
     except:
         return {"detail": "There is problems with database"}
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return aggregates
 
 @api_router.get("/lastsensordata/{sensor_id}", response_model=schema.SensorData)
 def last_sensor_data(sensor_id: str, db: Session = Depends(db.get_db)):
+    try:
+        last_data = crud.get_last_sensor_data(db=db, sensor_id=sensor_id)
+    except:
+        return {"detail": "There is problems with database"}
+    if last_data:
+        return last_data
     sensor = crud.get_sensor(db=db, sensor_id=sensor_id)
     if not sensor:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="There is no such sensor. Please check device ID"
         )
+    return {"detail": "There is no available data"}
+
+@api_router.get("/lastdata/{system_id}", response_model=schema.SystemLastData)
+def last_system_data(system_id: int, db: Session = Depends(db.get_db)):
+    system = crud.get_system(db=db, system_id=system_id)
+    if not system:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Please select active system ID"
+        )
     try:
-        last_data = crud.get_sensor_data(db=db, sensor_id=sensor_id)
-        if not last_data:
-            return {"detail": "There is no available data"}
-        return last_data
+        sensors = crud.get_system_last_sensor_data(db=db, system_id=system_id)
+        pumps = crud.get_system_last_flow_data(db=db, system_id=system_id)
     except:
-        return {"detail": "There is problems with database"}
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Something went wrong with connection to database"
+        )
+    return {"sensors": {data.sensor_id: data for data in sensors},
+            "pumps": {data.pump_id: data for data in pumps}}
 
-@api_router.get("/sensor_settings/{system_id}")
-def sensor_settings(system_id: int, db: Session = Depends(db.get_db)):
+# Export of device history
+def export_response(columns: list, query, fmt: str, filename: str):
+    return StreamingResponse(
+        export.stream_export(columns=columns, query=query, fmt=fmt),
+        media_type=export.MEDIA_TYPES[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{fmt}"'}
+    )
+
+@api_router.get("/export/sensordata/{sensor_id}")
+def export_sensor_data(sensor_id: str, date_from: Optional[datetime] = Query(None, alias="from"),
+                       date_to: Optional[datetime] = Query(None, alias="to"),
+                       fmt: str = Query("ndjson", alias="format", pattern="^(ndjson|csv)$"),
+                       db: Session = Depends(db.get_db)):
+    sensor = crud.get_sensor(db=db, sensor_id=sensor_id)
+    if not sensor:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="There is no such sensor. Please check device ID"
+        )
+    query = export.sensor_data_query(sensor_id=sensor_id, date_from=date_from, date_to=date_to)
+    return export_response(columns=export.SENSOR_DATA_COLUMNS, query=query, fmt=fmt,
+                           filename=f"sensor_{sensor_id}")
+
+@api_router.get("/export/flowdata/{pump_id}")
+def export_flow_data(pump_id: str, date_from: Optional[datetime] = Query(None, alias="from"),
+                     date_to: Optional[datetime] = Query(None, alias="to"),
+                     fmt: str = Query("ndjson", alias="format", pattern="^(ndjson|csv)$"),
+                     db: Session = Depends(db.get_db)):
+    pump = crud.get_pump(db=db, pump_id=pump_id)
+    if not pump:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="There is no such pump. Please check device ID"
+        )
+    query = export.flow_data_query(pump_id=pump_id, date_from=date_from, date_to=date_to)
+    return export_response(columns=export.FLOW_DATA_COLUMNS, query=query, fmt=fmt,
+                           filename=f"pump_{pump_id}")
+
+@api_router.get("/export/system/{system_id}/sensordata")
+def export_system_sensor_data(system_id: int, date_from: Optional[datetime] = Query(None, alias="from"),
+                              date_to: Optional[datetime] = Query(None, alias="to"),
+                              fmt: str = Query("ndjson", alias="format", pattern="^(ndjson|csv)$"),
+                              db: Session = Depends(db.get_db)):
     system = crud.get_system(db=db, system_id=system_id)
     if not system:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Please select active system ID"
         )
+    query = export.sensor_data_query(system_id=system_id, date_from=date_from, date_to=date_to)
+    return export_response(columns=export.SENSOR_DATA_COLUMNS, query=query, fmt=fmt,
+                           filename=f"system_{system_id}_sensors")
+
+@api_router.get("/export/system/{system_id}/flowdata")
+def export_system_flow_data(system_id: int, date_from: Optional[datetime] = Query(None, alias="from"),
+                            date_to: Optional[datetime] = Query(None, alias="to"),
+                            fmt: str = Query("ndjson", alias="format", pattern="^(ndjson|csv)$"),
+                            db: Session = Depends(db.get_db)):
+    system = crud.get_system(db=db, system_id=system_id)
+    if not system:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Please select active system ID"
+        )
+    query = export.flow_data_query(system_id=system_id, date_from=date_from, date_to=date_to)
+    return export_response(columns=export.FLOW_DATA_COLUMNS, query=query, fmt=fmt,
+                           filename=f"system_{system_id}_pumps")
+
+@api_router.get("/sensor_settings/{system_id}")
+def sensor_settings(system_id: int, request: Request, response: Response, db: Session = Depends(db.get_db)):
+    exists, etag = crud.get_system_version(db=db, system_id=system_id, resource="sensors")
+    if not exists:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Please select active system ID"
+        )
+    if is_not_modified(request=request, etag=etag):
+        return not_modified_response(etag=etag)
+    set_etag(response=response, etag=etag)
     system_sensors = crud.get_system_sensors(db=db, system_id=system_id)
     sensors = []
     for sensor in system_sensors:
@@ -1034,15 +989,18 @@ def sensor_settings(system_id: int, db: Session = Depends(db.get_db)):
 
 # Valve routes 
 @api_router.get("/valvestatus/{system_id}")
-def get_valve_status(system_id: int, db: Session = Depends(db.get_db)):
-    system = crud.get_system(db=db, system_id=system_id)
-    if not system:
+async def get_valve_status(system_id: int, request: Request, response: Response, db: AsyncSession = Depends(db.get_async_db)):
+    exists, etag = await crud.async_get_system_version(db=db, system_id=system_id, resource="valves")
+    if not exists:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Please select active system ID"
         )
+    if is_not_modified(request=request, etag=etag):
+        return not_modified_response(etag=etag)
+    set_etag(response=response, etag=etag)
     try:
-        valves = crud.get_system_valves(db=db, system_id=system_id)
+        valves = await crud.async_get_system_valves(db=db, system_id=system_id)
         valve_status = []
         for valve in valves:
             valve_status.append({valve.valve_id: valve.status})
@@ -1051,27 +1009,106 @@ def get_valve_status(system_id: int, db: Session = Depends(db.get_db)):
         return {"detail": "There is problems with database"}
 
 @api_router.patch("/valve/{valve_id}")
-def change_valve_status(valve_id: str, valve: schema.UpdateValveStatus, db: Session = Depends(db.get_db)):
-    existing_valve = crud.get_valve(db=db, valve_id=valve_id)
-    if not existing_valve:
-        return {"detail": "Could not found valve in database"}
+async def change_valve_status(valve_id: str, valve: schema.UpdateValveStatus, db: AsyncSession = Depends(db.get_async_db)):
     try:
-        crud.update_valve_status(db=db, valve=valve, valve_id=valve_id)
-        return {"detail": "Successfully updated database"}
+        updated = await crud.async_update_valve_status(db=db, valve=valve, valve_id=valve_id)
     except:
         return {"detail": "Something went wrong with database"}
+    if not updated:
+        return {"detail": "Could not found valve in database"}
+    return {"detail": "Successfully updated database"}
+
+# Push valve changes and live device data over WebSockets
+async def valve_snapshot(system_id: int):
+    async with db.AsyncSessionLocal() as session:
+        system = await crud.async_get_system(db=session, system_id=system_id)
+        if not system:
+            return None
+        valves = await crud.async_get_system_valves(db=session, system_id=system_id)
+        return {"valves": {valve.valve_id: valve.status for valve in valves}}
+
+async def system_snapshot(system_id: int):
+    async with db.AsyncSessionLocal() as session:
+        system = await crud.async_get_system(db=session, system_id=system_id)
+        return {} if system else None
+
+async def watch_disconnect(websocket: WebSocket, subscription: pubsub.Subscription):
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+    finally:
+        subscription.close()
+
+# Snapshot is a coroutine returning the initial state, or None for a missing system
+async def stream_topic(websocket: WebSocket, topic: str, epoch: Optional[str], seq: Optional[int], snapshot):
+    await websocket.accept()
+    subscription, current, backlog = pubsub.hub.subscribe(topic, epoch=epoch, since=seq)
+    watcher = None
+    try:
+        if backlog is None:
+            try:
+                state = await snapshot()
+            except:
+                await websocket.close(code=1011, reason="There is problems with database")
+                return
+            if state is None:
+                await websocket.close(code=4404, reason="Please select active system ID")
+                return
+            await websocket.send_json({"type": "snapshot", "epoch": pubsub.hub.epoch,
+                                       "seq": current, **state})
+        else:
+            await websocket.send_json({"type": "resume", "epoch": pubsub.hub.epoch, "seq": current})
+            for event in backlog:
+                await websocket.send_json(event)
+        watcher = asyncio.create_task(watch_disconnect(websocket=websocket, subscription=subscription))
+        while True:
+            event = await subscription.get()
+            if event is None:
+                break
+            await websocket.send_json(event)
+        if subscription.overflowed:
+            # Client reconnects with its last seq and replays from the buffer
+            await websocket.close(code=1013, reason="Resume from last sequence number")
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        pubsub.hub.unsubscribe(subscription)
+        if watcher:
+            watcher.cancel()
+
+@api_router.websocket("/ws/valves/{system_id}")
+async def valve_channel(websocket: WebSocket, system_id: int, epoch: Optional[str] = None,
+                        seq: Optional[int] = None):
+    await stream_topic(websocket=websocket, topic=pubsub.valve_topic(system_id), epoch=epoch, seq=seq,
+                       snapshot=lambda: valve_snapshot(system_id=system_id))
+
+# Live sensor and flow records for dashboards, current values come from /lastdata
+@api_router.websocket("/ws/data/{system_id}")
+async def data_channel(websocket: WebSocket, system_id: int, epoch: Optional[str] = None,
+                       seq: Optional[int] = None):
+    await stream_topic(websocket=websocket, topic=pubsub.data_topic(system_id), epoch=epoch, seq=seq,
+                       snapshot=lambda: system_snapshot(system_id=system_id))
 
 # Logs of devices events
 @api_router.post("/log/{id}")
-def create_log(log: schema.LogCreate, id: str, db: Session = Depends(db.get_db)):
-    pump = crud.get_pump(db=db, pump_id=id)
-    valve = crud.get_valve(db=db, valve_id=id)
-    sensor = crud.get_sensor(db=db, sensor_id=id)
-    if not pump and not valve and not sensor:
+async def create_log(log: schema.LogCreate, id: str, db: AsyncSession = Depends(db.get_async_db)):
+    try:
+        kind = await crud.async_get_device_kind(db=db, dev_id=id)
+    except:
+        return {"detail": "There is problems with database"}
+    if not kind:
         return {"detail": "Couldn't find device in database. Check if input is valid!"}
-    else:
-        crud.create_log(db=db, log=log)
-        return {"detail": "Successfully updated log"}
+    entry = log.dict()
+    entry["dev_id"] = id
+    if not logbuffer.add(entry):
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Log buffer is full. Please retry later",
+            headers={"Retry-After": str(max(1, int(config.settings.log_flush_interval)))}
+        )
+    return {"detail": "Successfully updated log"}
 
 @api_router.get("/systemlogs", response_model=List[List[schema.Logs]])
 def get_system_logs(system_id: int, db: Session = Depends(db.get_db)):
@@ -1081,35 +1118,122 @@ def get_system_logs(system_id: int, db: Session = Depends(db.get_db)):
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Please select active system ID"
         )
-    pump_logs = []
-    valve_logs = []
-    sensor_logs = []
-    for pump in system.system_pumps:
-        pumps_logs = crud.get_dev_logs(db=db, dev_id=pump.pump_id)
-        for pump_log in pumps_logs:
-            pump_logs.append(pump_log)
-    for valve in system.system_valves:
-        valves_logs = crud.get_dev_logs(db=db, dev_id=valve.valve_id)
-        for valve_log in valves_logs:
-            valve_logs.append(valve_log)
-    for sensor in system.system_sensors:
-        sensors_logs = crud.get_dev_logs(db=db, dev_id=sensor.sensor_id)
-        for sensor_log in sensors_logs:
-            sensor_logs.append(sensor_log)
-    return [pump_logs, valve_logs, sensor_logs]
+    logs = crud.get_system_logs_by_kind(db=db, system_id=system_id)
+    return [logs["pump"], logs["valve"], logs["sensor"]]
 
-# API routes for getting setting
-@api_router.get("/system_shifts/{system_id}", response_model=List[schema.Shifts])
-def get_systems_shifts(system_id: int, db: Session = Depends(db.get_db)):
+@api_router.get("/systemlogs/{system_id}", response_model=List[schema.Logs])
+def system_logs_page(system_id: int, response: Response, date_from: Optional[datetime] = Query(None, alias="from"),
+                     date_to: Optional[datetime] = Query(None, alias="to"), disable: Optional[bool] = None,
+                     cursor: Optional[str] = None,
+                     limit: int = Query(crud.HISTORY_PAGE_SIZE, ge=1, le=crud.MAX_HISTORY_PAGE_SIZE),
+                     db: Session = Depends(db.get_db)):
     system = crud.get_system(db=db, system_id=system_id)
     if not system:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Please select active system ID"
         )
+    after = get_cursor(cursor)
+    try:
+        logs, next_cursor = crud.get_system_logs_page(
+            db=db, system_id=system_id, date_from=date_from, date_to=date_to,
+            disable=disable, after=after, limit=limit)
+    except:
+        return {"detail": "There is problems with database"}
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return logs
+
+# API routes for getting setting
+@api_router.get("/system_shifts/{system_id}", response_model=List[schema.Shifts])
+def get_systems_shifts(system_id: int, request: Request, response: Response, db: Session = Depends(db.get_db)):
+    exists, etag = crud.get_system_version(db=db, system_id=system_id, resource="shifts")
+    if not exists:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Please select active system ID"
+        )
+    if is_not_modified(request=request, etag=etag):
+        return not_modified_response(etag=etag)
+    set_etag(response=response, etag=etag)
     shifts = crud.get_system_shifts(db=db, system_id=system_id)
     return shifts
 
+# Connection pool metrics
+@api_router.get("/pool_status")
+def get_pool_status(current_user: str = Depends(crud.get_current_user)):
+    if not current_user.admin:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="You are not authorized to update database"
+        )
+    return db.pool_status()
+
+# Live channel subscribers
+@api_router.get("/pubsub_status")
+def get_pubsub_status(current_user: str = Depends(crud.get_current_user)):
+    if not current_user.admin:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="You are not authorized to update database"
+        )
+    return pubsub.hub.status()
+
+# Device log buffer metrics
+@api_router.get("/log_status")
+def get_log_status(current_user: str = Depends(crud.get_current_user)):
+    if not current_user.admin:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="You are not authorized to update database"
+        )
+    return logbuffer.buffer_status()
+
+# Password hashing pool metrics
+@api_router.get("/hash_status")
+def get_hash_status(current_user: str = Depends(crud.get_current_user)):
+    if not current_user.admin:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="You are not authorized to update database"
+        )
+    return hashing.pool_status()
+
+# Desired valve states from the sections' moisture rules
+@api_router.get("/evaluate/{system_id}", response_model=List[schema.SectionEvaluation])
+async def evaluate_system(system_id: int, db: AsyncSession = Depends(db.get_async_db)):
+    try:
+        rows = await crud.async_get_section_moisture(db=db, system_id=system_id)
+        if not rows and not await crud.async_get_system(db=db, system_id=system_id):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Please select active system ID"
+            )
+    except HTTPException:
+        raise
+    except:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Something went wrong with connection to database"
+        )
+    return evaluation.evaluate_sections(rows)
+
+# Compiled irrigation schedule for controllers
+@api_router.get("/schedule/{system_id}", response_model=List[schema.ScheduleEvent])
+def get_system_schedule(system_id: int, days: int = Query(7, ge=1, le=schedule.MAX_SCHEDULE_DAYS),
+                        db: Session = Depends(db.get_db)):
+    exists, version = crud.get_system_version(db=db, system_id=system_id, resource="shifts")
+    if not exists:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Please select active system ID"
+        )
+    template = schedule.get_compiled(system_id, version)
+    if template is None:
+        template = schedule.compile_shifts(crud.get_system_shifts(db=db, system_id=system_id))
+        schedule.set_compiled(system_id, version, template)
+    return schedule.upcoming_events(template=template, now=datetime.now(), days=days)
+
 # Get current time
 @api_router.get("/timestamp", response_model=schema.CurrentTime)
 def return_current_time():
@@ -0,0 +1,111 @@
+from bisect import bisect_left
+from datetime import datetime, time, timedelta
+from typing import Optional
+
+from config import settings
+import cache
+
+DAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+MAX_SCHEDULE_DAYS = 14
+
+def to_seconds(value: Optional[time]):
+    if value is None:
+        return None
+    return value.hour * 3600 + value.minute * 60 + value.second
+
+class WeeklyIntervalIndex:
+    # Sorted [start, stop) intervals per weekday with a running maximum of the
+    # stop times, so one bisect answers whether anything overlaps a new timer.
+    # Zero-length timers only clash with a zero-length timer at the same time.
+    def __init__(self, timers: list):
+        intervals = {day: [] for day in DAYS}
+        self.points = {day: set() for day in DAYS}
+        for timer in timers:
+            starts, stops = to_seconds(timer.starts), to_seconds(timer.stops)
+            if starts is None or stops is None or starts > stops:
+                continue
+            for day in DAYS:
+                if not getattr(timer, day):
+                    continue
+                if starts == stops:
+                    self.points[day].add(starts)
+                else:
+                    intervals[day].append((starts, stops))
+        self.starts = {}
+        self.max_stops = {}
+        for day in DAYS:
+            intervals[day].sort()
+            self.starts[day] = [starts for starts, _ in intervals[day]]
+            max_stops = []
+            for _, stops in intervals[day]:
+                max_stops.append(max(stops, max_stops[-1]) if max_stops else stops)
+            self.max_stops[day] = max_stops
+
+    def overlaps_day(self, day: str, starts: int, stops: int):
+        if starts == stops:
+            return starts in self.points[day]
+        before = bisect_left(self.starts[day], stops)
+        return before > 0 and self.max_stops[day][before - 1] > starts
+
+    def overlaps(self, timer):
+        starts, stops = to_seconds(timer.starts), to_seconds(timer.stops)
+        if starts is None or stops is None or starts > stops:
+            return False
+        return any(getattr(timer, day) and self.overlaps_day(day, starts, stops) for day in DAYS)
+
+# Compiled schedules are weekly templates, one entry per timer with the
+# rules of every section in its shift. Templates are stored with the
+# version of the system's shifts, sections, timers and sensor controllers,
+# so a change made through any worker is picked up on the next request.
+compiled_schedules = cache.MemoryCache()
+
+def get_compiled(system_id: int, version: str):
+    entry = compiled_schedules.get(str(system_id))
+    if entry is None or entry[0] != version:
+        return None
+    return entry[1]
+
+def set_compiled(system_id: int, version: str, template: list):
+    compiled_schedules.set(str(system_id), (version, template), settings.schedule_cache_ttl)
+
+def invalidate(system_id: int):
+    compiled_schedules.delete(str(system_id))
+
+def compile_shifts(shifts: list):
+    template = []
+    for shift in shifts:
+        rules = [{"valve_id": section.valve_id,
+                  "sensors_settings": section.sensors_settings,
+                  "starts_at": section.starts_at,
+                  "stops_at": section.stops_at,
+                  "sensors": [controler.sensor_id for controler in section.section_sensors
+                              if controler.sensor_id]}
+                 for section in shift.shifts_sections]
+        for timer in shift.shift_timers:
+            # Same timers the conflict index skips, runs never pass midnight
+            if timer.starts is None or timer.stops is None or timer.starts >= timer.stops:
+                continue
+            weekdays = [index for index, day in enumerate(DAYS) if getattr(timer, day)]
+            if not weekdays:
+                continue
+            template.append({"shift_id": shift.id, "weekdays": weekdays,
+                             "starts": timer.starts, "stops": timer.stops,
+                             "valve_ids": [rule["valve_id"] for rule in rules], "rules": rules})
+    return template
+
+def upcoming_events(template: list, now: datetime, days: int):
+    events = []
+    today = now.date()
+    for offset in range(days):
+        date = today + timedelta(days=offset)
+        for entry in template:
+            if date.weekday() not in entry["weekdays"]:
+                continue
+            start = datetime.combine(date, entry["starts"])
+            stop = datetime.combine(date, entry["stops"])
+            if stop <= now or start >= now + timedelta(days=days):
+                continue
+            events.append({"shift_id": entry["shift_id"], "start": start, "stop": stop,
+                           "valve_ids": entry["valve_ids"], "rules": entry["rules"]})
+    events.sort(key=lambda event: (event["start"], event["shift_id"]))
+    return events
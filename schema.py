@@ -1,6 +1,6 @@
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, Field
 from datetime import datetime, time
-from typing import Optional, Union, List
+from typing import Optional, Union, List, Dict
 
 # Pump's schemas
 class Flow(BaseModel):
@@ -108,6 +108,42 @@ class SensorData(BaseModel):
             datetime: lambda v: v.timestamp(),
         }
 
+class BatchResult(BaseModel):
+    index: int
+    device_id: str
+    accepted: bool
+    detail: str
+
+class BatchResponse(BaseModel):
+    accepted: int
+    rejected: int
+    results: List[BatchResult] = []
+
+class SystemLastData(BaseModel):
+    sensors: Dict[str, SensorData] = {}
+    pumps: Dict[str, GetFlowData] = {}
+
+class AggregateValue(BaseModel):
+    min: Optional[float] = None
+    max: Optional[float] = None
+    avg: Optional[float] = None
+
+class SensorDataBucket(BaseModel):
+    bucket: datetime
+    count: int
+    level_1: AggregateValue
+    level_2: AggregateValue
+    level_3: AggregateValue
+    temp_1: AggregateValue
+    temp_2: AggregateValue
+    temp_3: AggregateValue
+    moisture: AggregateValue
+    bat_level: AggregateValue
+    class Config:
+        json_encoders = {
+            datetime: lambda v: v.timestamp(),
+        }
+
 class SensorControler(BaseModel):
     section_id: int
     sensor_id: Optional[str]
@@ -131,7 +167,7 @@ class SControlWithID(BaseModel):
 class SectionCreate(BaseModel):
     shift_id: int
     valve_id: str
-    updated_at: datetime = datetime.now()
+    updated_at: datetime = Field(default_factory=datetime.now)
 
 class SectionUpdate(BaseModel):
     sensors_settings: Optional[str]
@@ -169,7 +205,7 @@ class TimerControl(BaseModel):
     Sun: Optional[bool] = None
     starts: Optional[time] = None
     stops: Optional[time] = None
-    updated_at: datetime = datetime.now()
+    updated_at: datetime = Field(default_factory=datetime.now)
     def serialize(self):
         return {"Mon": self.Mon, "Tue": self.Tue, "Wed": self.Wed, "Thu": self.Thu,
                 "Fri": self.Fri, "Sat": self.Sat, "Sun": self.Sun,
@@ -216,11 +252,11 @@ class TControlWithID(BaseModel):
 
 class AddShift(BaseModel):
     system_id: int
-    created_at: datetime = datetime.now()
-    updated_at: datetime = datetime.now()
+    created_at: datetime = Field(default_factory=datetime.now)
+    updated_at: datetime = Field(default_factory=datetime.now)
 
 class UpdateShift(BaseModel):
-    updated_at: datetime = datetime.now()
+    updated_at: datetime = Field(default_factory=datetime.now)
 
 class Shifts(BaseModel):
     id: int
@@ -239,6 +275,34 @@ class ShiftsWithID(BaseModel):
     class Config:
         from_attributes = True
 
+class ScheduleRule(BaseModel):
+    valve_id: str
+    sensors_settings: Optional[str] = None
+    starts_at: Optional[float] = None
+    stops_at: Optional[float] = None
+    sensors: List[str] = []
+
+class ScheduleEvent(BaseModel):
+    shift_id: int
+    start: datetime
+    stop: datetime
+    valve_ids: List[str] = []
+    rules: List[ScheduleRule] = []
+    class Config:
+        json_encoders = {
+            datetime: lambda v: v.timestamp(),
+        }
+
+class SectionEvaluation(BaseModel):
+    section_id: int
+    valve_id: Optional[str]
+    sensors_settings: Optional[str]
+    moisture: Optional[float]
+    sensors: int
+    status: Optional[bool]
+    desired: Optional[bool]
+    reason: str
+
 class SystemBase(BaseModel):
     name: str
     location: str
@@ -377,6 +441,15 @@ class Token(BaseModel):
 class TokenData(BaseModel):
     username: Union[str, None] = None
     
+class Principal(BaseModel):
+    username: str
+    email: EmailStr
+    admin: bool
+    premium: bool
+    delisted: bool
+    class Config:
+        from_attributes = True
+    
 class Login(BaseModel):
     username: str
     password: str
@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+# Tests need a Postgres database of their own, its tables are created and
+# dropped by the tests. Point TEST_POSTGRES_DB_NAME at it, the other
+# connection settings come from the environment or .env as usual.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TEST_DB_NAME = os.environ.get("TEST_POSTGRES_DB_NAME")
+if TEST_DB_NAME:
+    os.environ["POSTGRES_DB_NAME"] = TEST_DB_NAME
+    for key, value in {"SECRET_KEY": "test", "ALGORITHM": "HS256", "ACCESS_TOKEN_EXPIRE_MINUTES": "30",
+                       "EMAIL": "test@example.com", "PASSWORD": ""}.items():
+        os.environ.setdefault(key, value)
+
+def pytest_collection_modifyitems(config, items):
+    if TEST_DB_NAME:
+        return
+    skip = pytest.mark.skip(reason="Set TEST_POSTGRES_DB_NAME to run database tests")
+    for item in items:
+        item.add_marker(skip)
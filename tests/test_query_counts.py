@@ -0,0 +1,122 @@
+from datetime import time
+
+import pytest
+from sqlalchemy import event
+
+from conftest import TEST_DB_NAME
+
+if not TEST_DB_NAME:
+    pytest.skip("Set TEST_POSTGRES_DB_NAME to run database tests", allow_module_level=True)
+
+from fastapi.testclient import TestClient
+
+import cache
+import config
+import db
+import models
+from main import app
+
+# Statements per request no matter how many rows the trees hold
+MAX_USERS_STATEMENTS = 10
+MAX_SYSTEM_SHIFTS_STATEMENTS = 5
+
+@pytest.fixture
+def engine():
+    db.init_engine()
+    models.Base.metadata.drop_all(bind=db.engine)
+    models.Base.metadata.create_all(bind=db.engine)
+    yield db.engine
+    models.Base.metadata.drop_all(bind=db.engine)
+
+@pytest.fixture
+def client(engine):
+    return TestClient(app)
+
+@pytest.fixture
+def statements(engine):
+    executed = []
+    def count(conn, cursor, statement, parameters, context, executemany):
+        executed.append(statement)
+    event.listen(engine, "before_cursor_execute", count)
+    yield executed
+    event.remove(engine, "before_cursor_execute", count)
+
+@pytest.fixture
+def connections(engine):
+    held = {"current": 0, "max": 0}
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        held["current"] += 1
+        held["max"] = max(held["max"], held["current"])
+    def checkin(dbapi_connection, connection_record):
+        held["current"] -= 1
+    event.listen(engine.pool, "checkout", checkout)
+    event.listen(engine.pool, "checkin", checkin)
+    yield held
+    event.remove(engine.pool, "checkout", checkout)
+    event.remove(engine.pool, "checkin", checkin)
+
+def add_users(count: int, systems: int, children: int):
+    session = db.SessionLocal()
+    system_ids = []
+    for u in range(count):
+        username = f"user{u}"
+        session.add(models.User(username=username, email=f"{username}@example.com", name="Name",
+                                surname="Surname", address="Address", admin=False, premium=False,
+                                delisted=False))
+        session.add_all([models.Notification(user=username, message="Note", read=False)
+                         for _ in range(children)])
+        for s in range(systems):
+            system = models.System(owner=username, systemID=f"{username}-{s}", name="System",
+                                   location="Field", fruit="Apple", area=1.0)
+            session.add(system)
+            session.flush()
+            system_ids.append(system.id)
+            prefix = f"{u}-{s}"
+            for c in range(children):
+                session.add(models.Pump(pump_id=f"p{prefix}-{c}", system_id=system.id, capacity=1.0, current=1.0))
+                session.add(models.Valve(valve_id=f"v{prefix}-{c}", system_id=system.id, status=False))
+                session.add(models.Sensor(sensor_id=f"s{prefix}-{c}", system_id=system.id, readings=50,
+                                          temp=15, set_lvl_1=False, set_lvl_2=True, set_lvl_3=False))
+            session.flush()
+            for c in range(children):
+                shift = models.Shift(system_id=system.id)
+                session.add(shift)
+                session.flush()
+                section = models.Section(shift_id=shift.id, valve_id=f"v{prefix}-{c}",
+                                         sensors_settings="AVG", starts_at=20, stops_at=60)
+                session.add(section)
+                session.add(models.Timer(shift_id=shift.id, Mon=True, starts=time(6, c), stops=time(7, c)))
+                session.flush()
+                session.add(models.SensorControler(section_id=section.id, sensor_id=f"s{prefix}-{c}"))
+    session.commit()
+    session.close()
+    return system_ids
+
+@pytest.mark.parametrize("users, systems, children", [(1, 1, 1), (5, 3, 4)])
+def test_users_statement_count(client, statements, users, systems, children):
+    add_users(count=users, systems=systems, children=children)
+    statements.clear()
+    response = client.get("/users")
+    assert response.status_code == 200
+    assert len(response.json()) == users
+    assert len(statements) <= MAX_USERS_STATEMENTS
+
+@pytest.mark.parametrize("children", [1, 10])
+def test_system_shifts_statement_count(client, statements, children):
+    system_id = add_users(count=1, systems=1, children=children)[0]
+    statements.clear()
+    response = client.get(f"/api/system_shifts/{system_id}")
+    assert response.status_code == 200
+    assert len(response.json()) == children
+    assert len(statements) <= MAX_SYSTEM_SHIFTS_STATEMENTS
+
+def test_cold_auth_holds_one_connection(client, connections):
+    add_users(count=1, systems=1, children=1)
+    with db.SessionLocal() as session:
+        shift_id = session.query(models.Shift.id).scalar()
+    cache.invalidate_principal("user0")
+    client.cookies.set("Authorization", f"Bearer {config.create_access_token(data={'sub': 'user0'})}")
+    connections["max"] = 0
+    response = client.get(f"/base/available_valves/{shift_id}")
+    assert response.status_code == 200
+    assert connections["max"] == 1